@@ -15,15 +15,19 @@ import subprocess
 
 def run_command(command, out=subprocess.PIPE):
     try:
-        print "Running command: {}".format(" ".join(x for x in command).rstrip())
+        print("Running command: {}".format(" ".join(x for x in command).rstrip()))
         proc = subprocess.Popen(command,
                                 stdout=out, stderr=subprocess.PIPE,
-                                close_fds=True, shell=False)
+                                close_fds=True, shell=False,
+                                universal_newlines=True)
         (stdout, errmsg) = proc.communicate()
-        print stdout
-        print errmsg
+        print(stdout)
+        print(errmsg)
     except Exception as e:
         raise e
+    # Some programs write to stderr on success so the exit code is checked
+    if proc.returncode != 0:
+        raise RuntimeError("The command returned the error code {}\n".format(proc.returncode))
                
 def main(run_path, indexes, out_path):
 
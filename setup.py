@@ -56,7 +56,8 @@ setup(
   ext_modules=[
         Extension('stpipeline.common.cdistance', ['stpipeline/common/cdistance.pyx']),
         Extension('stpipeline.common.unique_events_parser', ['stpipeline/common/unique_events_parser.pyx']),
-        Extension('stpipeline.common.filterInputReads', ['stpipeline/common/filterInputReads.pyx'])
+        Extension('stpipeline.common.filterInputReads', ['stpipeline/common/filterInputReads.pyx']),
+        Extension('stpipeline.common.cfastq_utils', ['stpipeline/common/cfastq_utils.pyx'])
     ],
   include_package_data = True,
   zip_safe = False,
@@ -3,6 +3,98 @@ This module contains some functions to find and removes adaptors in fastq reads
 """
 import regex
 
+# The compiled patterns used to search adaptors allowing miss-matches
+_adaptor_patterns = {}
+
+def adaptorPattern(adaptor, missmatches):
+    """
+    Returns the compiled pattern to find the adaptor allowing
+    the given number of miss-matches (patterns are compiled only once)
+    :param adaptor: the adaptor sequence
+    :param missmatches: allow number of missmatches
+    :type adaptor: str or bytes
+    :type missmatches: int
+    :return: the compiled pattern
+    """
+    key = (adaptor, missmatches)
+    pattern = _adaptor_patterns.get(key)
+    if pattern is None:
+        pattern = r'(?:%s){s<=%d}'
+        if isinstance(adaptor, bytes):
+            pattern = pattern.encode()
+        pattern = regex.compile(pattern % (adaptor, missmatches))
+        _adaptor_patterns[key] = pattern
+    return pattern
+
+def findAdaptor(sequence, adaptor, missmatches=2, end=None):
+    """
+    Tries to find the given adaptor sequence in the given sequence
+    and returns the position of the adaptor's first base.
+    Only the first end bases of the sequence are searched (all if end is None)
+    so reads that were already trimmed do not need to be sliced.
+    :param sequence: the sequence of the read
+    :param adaptor: the adaptor sequence
+    :param missmatches: allow number of missmatches when searching for the adaptor
+    :param end: the position where the read ends
+    :type sequence: str or bytes
+    :type adaptor: str or bytes (same type as the sequence)
+    :type missmatches: int
+    :type end: int
+    :return: the position of the adaptor or -1 if it is not found
+    :rtype: int
+    """
+    if end is None:
+        end = len(sequence)
+    if end < len(adaptor):
+        return -1
+    # TODO this is slow, find a faster approach
+    if missmatches == 0:
+        return sequence.find(adaptor, 0, end)
+    candidates = adaptorPattern(adaptor, missmatches).findall(sequence, endpos=end, overlapped=False)
+    if len(candidates) > 0:
+        local_seq = candidates[0]
+        # Miss-matches may happen at the start
+        # so we account for it
+        local_pos = 0
+        if adaptor[0] != local_seq[0]:
+            local_pos = local_seq.find(adaptor[0])
+        # We now look for the first base of the matched adaptor
+        return sequence.find(local_seq[local_pos:], 0, end)
+    return -1
+
+def findAdaptors(sequence, adaptors, missmatches=2, end=None, min_length=0):
+    """
+    Removes the given adaptors (in order) from the given sequence and 
+    returns the position where the read ends after removing them.
+    The read is not sliced, each adaptor is searched before the position
+    where the previous one was found. It stops when the read is not longer
+    than min_length.
+    :param sequence: the sequence of the read
+    :param adaptors: the list of adaptor sequences
+    :param missmatches: allow number of missmatches when searching for the adaptors
+    :param end: the position where the read ends
+    :param min_length: the min length of the read to keep searching
+    :type sequence: str or bytes
+    :type adaptors: list of str or bytes (same type as the sequence)
+    :type missmatches: int
+    :type end: int
+    :type min_length: int
+    :return: the position where the read ends
+    :rtype: int
+    """
+    if end is None:
+        end = len(sequence)
+    for adaptor in adaptors:
+        if end <= min_length:
+            break
+        if missmatches == 0:
+            pos = sequence.find(adaptor, 0, end)
+        else:
+            pos = findAdaptor(sequence, adaptor, missmatches, end)
+        if pos != -1:
+            end = pos
+    return end
+
 def removeAdaptor(sequence, quality, adaptor, missmatches=2):
     """
     Tries to find the given adaptor sequence in the given fastq read (sequence, quality)
@@ -12,41 +104,20 @@ def removeAdaptor(sequence, quality, adaptor, missmatches=2):
     :param quality: the quality of the read
     :param adaptor: the adaptor sequence
     :param missmatches: allow number of missmatches when searching for the adaptor
-    :type sequence: str
-    :type quality: str
-    :type adaptor: str
+    :type sequence: str or bytes
+    :type quality: str or bytes
+    :type adaptor: str or bytes (same type as the sequence)
     :type missmatches: int
     :return: a tuple (sequence,quality) with the adaptor trimmed
     :rtype: tuple
     """
-    if len(sequence) < len(adaptor) or len(sequence) != len(quality):
+    if len(sequence) != len(quality):
         return sequence, quality
     # Find adaptor and trim from the first position of 
     # the adaptor till the end of the read
-    # TODO this is slow, find a faster approach
-    if missmatches == 0:
-        pos = sequence.find(adaptor)
-    else:
-        candidates = regex.findall(r'(?:%s){s<=%s}' % (adaptor, missmatches), 
-                                   sequence, overlapped=False)
-        if len(candidates) > 0:
-            local_seq = candidates[0]
-            # Miss-matches may happen at the start
-            # so we account for it
-            local_pos = 0
-            if adaptor[0] != local_seq[0]:
-                local_pos = local_seq.find(adaptor[0])
-            # We now look for the first base of the matched adaptor
-            pos = sequence.find(local_seq[local_pos:])
-        else:
-            pos = -1
+    pos = findAdaptor(sequence, adaptor, missmatches)
     # Trim only if pos is correct          
     if pos != -1:
         return sequence[:pos], quality[:pos]
     else:
         return sequence, quality    
-
-            
-    
-    
-    
@@ -0,0 +1,318 @@
+#cython: language_level=3
+""" 
+This module contains the compiled (Cython) versions of 
+the per read functions used in the quality filtering of the fastq files.
+"""
+cimport cython
+from libc.stdlib cimport malloc, free
+from libc.string cimport memchr, memset
+
+# Max number of homopolymers searched without allocating memory
+cdef enum:
+    MAX_STACK_HOMOPOLYMERS = 8
+
+cpdef Py_ssize_t quality_trim_index(bytes bases, bytes qualities, int cutoff, int base=33,
+                                    Py_ssize_t end=-1):
+    """
+    Function snippet and modified from CutAdapt 
+    https://github.com/marcelm/cutadapt/
+    
+    Copyright (c) 2010-2016 Marcel Martin <marcel.martin@scilifelab.se>
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in
+    all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN C
+
+    Find the position at which to trim a low-quality end from a nucleotide sequence.
+
+    Qualities are assumed to be ASCII-encoded as chr(qual + base).
+
+    The algorithm is the same as the one used by BWA within the function
+    'bwa_trim_read':
+    - Subtract the cutoff value from all qualities.
+    - Compute partial sums from all indices to the end of the sequence.
+    - Trim sequence at the index at which the sum is minimal.
+    
+    This variant works on NextSeq data.
+    With Illumina NextSeq, bases are encoded with two colors. 'No color' (a
+    dark cycle) usually means that a 'G' was sequenced, but that also occurs
+    when sequencing falls off the end of the fragment. The read then contains
+    a run of high-quality G bases in the end.
+    This routine works as the one above, but counts qualities belonging to 'G'
+    bases as being equal to cutoff - 1.
+
+    The loop is typed so no Python objects are created per base.
+    Bases and qualities are given as bytes of the same length.
+    If end is given only the first end bases are considered
+    (the read was already trimmed at end).
+    """
+    cdef const unsigned char* b = bases
+    cdef const unsigned char* qual = qualities
+    cdef Py_ssize_t i
+    cdef int q
+    cdef int s = 0
+    cdef int max_qual = 0
+    cdef Py_ssize_t max_i = len(qualities) if end < 0 else end
+    if len(bases) < max_i or len(qualities) < max_i:
+        raise ValueError("Error trimming, sequence and quality have different lengths")
+    for i in range(max_i - 1, -1, -1):
+        if b[i] == b'G':
+            q = cutoff - 1
+        else:
+            q = qual[i] - base
+        s += cutoff - q
+        if s < 0:
+            break
+        if s > max_qual:
+            max_qual = s
+            max_i = i
+    return max_i
+
+cpdef tuple trim_quality(bytes sequence,
+                         bytes quality,
+                         int min_qual=20, 
+                         int min_length=30, 
+                         int phred=33,
+                         Py_ssize_t end=-1):    
+    """
+    Quality trims a fastq read using a BWA approach.
+    It returns the trimmed record or None if the number of bases
+    after trimming is below a minimum.
+    :param sequence: the sequence of bases of the read
+    :param quality: the quality scores of the read (ASCII encoded)
+    :param min_qual the quality threshold to trim (consider a base of bad quality)
+    :param min_length: the minimum length of a valid read after trimming
+    :param phred: the format of the quality string (33 or 64)
+    :param end: the position where the read ends (-1 for the whole read)
+    :type sequence: bytes
+    :type quality: bytes
+    :type min_qual: integer
+    :type min_length: integer
+    :type phred: integer
+    :type end: integer
+    :return: A tuple (base, qualities) or (None,None)
+    """
+    if end < 0:
+        end = len(sequence)
+    if end < min_length:
+        return None, None
+    # Get the position at which to trim (number of bases to trim)
+    cdef Py_ssize_t cut_index = quality_trim_index(sequence, quality, min_qual, phred, end)
+    # Check if the trimmed sequence would have min length (at least)
+    # if so return the trimmed read otherwise return None
+    if (cut_index + 1) >= min_length:
+        return sequence[:cut_index], quality[:cut_index]
+    else:
+        return None, None
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _high_content(const unsigned char[::1] sequences, const Py_ssize_t* lengths,
+                        Py_ssize_t num_sequences, const unsigned char* table,
+                        int max_content, unsigned char[::1] result) noexcept nogil:
+    cdef Py_ssize_t i, j
+    cdef Py_ssize_t start = 0
+    cdef Py_ssize_t count
+    for i in range(num_sequences):
+        count = 0
+        for j in range(start, start + lengths[i]):
+            count += table[sequences[j]]
+        result[i] = count * 100 >= max_content * lengths[i]
+        start += lengths[i]
+
+cpdef bytearray high_content(list sequences, bytes bases, int max_content):
+    """
+    Checks which sequences have more than max_content % of the given bases.
+    The sequences are joined and counted in one typed loop
+    that runs without the GIL.
+    The content is compared with integers to avoid the division.
+    :param sequences: list of sequences (bytes)
+    :param bases: the bases to count (for instance b"AT")
+    :param max_content: the % of bases for a sequence to be reported
+    :return: a bytearray with 1 for the sequences with high content (0 otherwise)
+    """
+    cdef Py_ssize_t num_sequences = len(sequences)
+    cdef bytearray result = bytearray(num_sequences)
+    if num_sequences == 0:
+        return result
+    cdef unsigned char[256] table
+    cdef Py_ssize_t i
+    for i in range(256):
+        table[i] = 0
+    for i in range(len(bases)):
+        table[<unsigned char>bases[i]] = 1
+    cdef const unsigned char[::1] joined = b"".join(sequences)
+    cdef unsigned char[::1] result_view = result
+    cdef Py_ssize_t* lengths = <Py_ssize_t*>malloc(num_sequences * sizeof(Py_ssize_t))
+    if lengths == NULL:
+        raise MemoryError()
+    try:
+        for i in range(num_sequences):
+            lengths[i] = len(sequences[i])
+        with nogil:
+            _high_content(joined, lengths, num_sequences, table, max_content, result_view)
+    finally:
+        free(lengths)
+    return result
+
+cpdef Py_ssize_t find_homopolymers(bytes sequence, bytes bases, tuple lengths,
+                                   Py_ssize_t end, Py_ssize_t min_length=0):
+    """
+    Removes the given homopolymers (in order) from the given sequence and 
+    returns the position where the read ends after removing them.
+    It gives the same result as findAdaptors() with no miss-matches but
+    the sequence is scanned only once to find the first run of every
+    homopolymer and then they are removed in order (each one must be 
+    before the position where the previous one was found and it stops when
+    the read is not longer than min_length).
+    :param sequence: the sequence of the read
+    :param bases: the base of each homopolymer (for instance b"AT")
+    :param lengths: the length of each homopolymer
+    :param end: the position where the read ends
+    :param min_length: the min length of the read to keep searching
+    :return: the position where the read ends
+    """
+    cdef Py_ssize_t num_adaptors = len(bases)
+    if num_adaptors == 0 or end <= min_length:
+        return end
+    if len(lengths) != num_adaptors:
+        raise ValueError("Error, the number of bases and lengths of the homopolymers differ")
+    if len(sequence) < end:
+        raise ValueError("Error, the end position is after the end of the sequence")
+    cdef const unsigned char* seq = sequence
+    cdef const unsigned char* b = bases
+    # The buffers are on the stack for the usual number of homopolymers
+    cdef Py_ssize_t first_buf[2 * MAX_STACK_HOMOPOLYMERS]
+    cdef Py_ssize_t* first = first_buf
+    if num_adaptors > MAX_STACK_HOMOPOLYMERS:
+        first = <Py_ssize_t*>malloc(2 * num_adaptors * sizeof(Py_ssize_t))
+        if first == NULL:
+            raise MemoryError()
+    cdef Py_ssize_t* min_run = first + num_adaptors
+    # Index of the homopolymer of each base (-1 none, -2 several)
+    cdef int adaptor_of[256]
+    cdef Py_ssize_t i, k, run_start
+    cdef int index
+    cdef unsigned char base
+    cdef Py_ssize_t pending = num_adaptors
+    try:
+        memset(adaptor_of, -1, sizeof(adaptor_of))
+        for k in range(num_adaptors):
+            first[k] = -1
+            min_run[k] = lengths[k]
+            adaptor_of[b[k]] = k if adaptor_of[b[k]] == -1 else -2
+        # Find the first run of each homopolymer (run by run as 
+        # the first run long enough starts where the run starts)
+        i = 0
+        while i < end and pending > 0:
+            run_start = i
+            base = seq[i]
+            i += 1
+            while i < end and seq[i] == base:
+                i += 1
+            index = adaptor_of[base]
+            if index >= 0:
+                if first[index] == -1 and i - run_start >= min_run[index]:
+                    first[index] = run_start
+                    pending -= 1
+            elif index == -2:
+                for k in range(num_adaptors):
+                    if first[k] == -1 and b[k] == base and i - run_start >= min_run[k]:
+                        first[k] = run_start
+                        pending -= 1
+        # Remove them in order
+        for k in range(num_adaptors):
+            if end <= min_length:
+                break
+            if first[k] != -1 and first[k] + min_run[k] <= end:
+                end = first[k]
+    finally:
+        if first != first_buf:
+            free(first)
+    return end
+
+cdef inline Py_ssize_t _find_new_line(const unsigned char* buf, Py_ssize_t start, Py_ssize_t buf_len):
+    if start >= buf_len:
+        return -1
+    cdef const unsigned char* p = <const unsigned char*>memchr(buf + start, 10, buf_len - start)
+    return -1 if p == NULL else p - buf
+
+cdef inline Py_ssize_t _line_end(const unsigned char* buf, Py_ssize_t start, Py_ssize_t end):
+    # The end of a line without the \r of the Windows new lines (\r\n)
+    return end - 1 if end > start and buf[end - 1] == 13 else end
+
+def readfq(fp, Py_ssize_t block_size=4194304): # this is a generator function
+    """ 
+    Parses fastq records from a file opened in binary mode using 
+    a generator approach. The file is read in big blocks and
+    the records are located by searching for the new line characters
+    in each block (no decoding of bases and qualities).
+    As the quality has the same length as the sequence the end of the record
+    is predicted and it is only searched when the prediction fails.
+    It assumes the standard 4 lines per record fastq format. 
+    Empty lines before a record and Windows new lines (\r\n) are allowed.
+    :param fp: opened file descriptor (binary mode)
+    :param block_size: the number of bytes to read each time
+    :returns an iterator over tuples (name,sequence,quality) of bytes
+    :raises: ValueError
+    """
+    cdef bytes buf = b""
+    cdef const unsigned char* data = buf
+    cdef Py_ssize_t buf_len = 0
+    cdef Py_ssize_t pos = 0
+    cdef Py_ssize_t header_end, seq_end, plus_end, qual_end
+    cdef bint eof = False
+    while True:
+        # Skip the empty lines before the record
+        while pos < buf_len and (data[pos] == 10 or data[pos] == 13): # \n or \r
+            pos += 1
+        header_end = _find_new_line(data, pos, buf_len)
+        seq_end = _find_new_line(data, header_end + 1, buf_len) if header_end != -1 else -1
+        qual_end = -1
+        if seq_end != -1:
+            # The plus line is usually empty (just +)
+            plus_end = seq_end + 2
+            qual_end = plus_end + seq_end - header_end
+            if qual_end >= buf_len or data[qual_end] != 10 \
+            or data[plus_end] != 10 or data[seq_end + 1] != 43: # \n and +
+                plus_end = _find_new_line(data, seq_end + 1, buf_len)
+                qual_end = _find_new_line(data, plus_end + 1, buf_len) if plus_end != -1 else -1
+        if qual_end == -1:
+            # The block does not contain a complete record
+            if eof:
+                if buf[pos:].strip():
+                    raise ValueError("Error parsing fastq file, truncated record found\n")
+                break
+            chunk = fp.read(block_size)
+            if chunk:
+                buf = buf[pos:] + chunk
+            else:
+                eof = True
+                buf = buf[pos:]
+                # The last record may not end with a new line
+                if buf and not buf.endswith(b"\n"):
+                    buf += b"\n"
+            data = buf
+            buf_len = len(buf)
+            pos = 0
+            continue
+        if data[pos] != 64: # @
+            raise ValueError("Error parsing fastq file, incorrect record " \
+                             "header {}\n".format(buf[pos:header_end]))
+        yield data[pos + 1:_line_end(data, pos + 1, header_end)], \
+              data[header_end + 1:_line_end(data, header_end + 1, seq_end)], \
+              data[plus_end + 1:_line_end(data, plus_end + 1, qual_end)]
+        pos = qual_end + 1
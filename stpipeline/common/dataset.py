@@ -214,19 +214,20 @@ def createDataset(input_file,
         logger.info("Number of discarded reads (possible duplicates): {}".format(discarded_reads))
         
     # Update the QA object
+    # (numpy scalars are converted so the stats can be written to JSON)
     qa_stats.reads_after_duplicates_removal = int(total_transcripts)
     qa_stats.unique_events = total_record
     qa_stats.barcodes_found = total_barcodes
     qa_stats.genes_found = number_genes
     qa_stats.duplicates_found = discarded_reads
-    qa_stats.max_genes_feature = max_genes_feature
-    qa_stats.min_genes_feature = min_genes_feature
-    qa_stats.max_reads_feature = max_reads_feature
-    qa_stats.min_reads_feature = min_reads_feature
-    qa_stats.max_reads_unique_event = max_count
-    qa_stats.min_reads_unique_event = min_count
-    qa_stats.average_gene_feature = average_genes_feature
-    qa_stats.average_reads_feature = average_reads_feature
+    qa_stats.max_genes_feature = int(max_genes_feature)
+    qa_stats.min_genes_feature = int(min_genes_feature)
+    qa_stats.max_reads_feature = int(max_reads_feature)
+    qa_stats.min_reads_feature = int(min_reads_feature)
+    qa_stats.max_reads_unique_event = int(max_count)
+    qa_stats.min_reads_unique_event = int(min_count)
+    qa_stats.average_gene_feature = float(average_genes_feature)
+    qa_stats.average_reads_feature = float(average_reads_feature)
      
     # Write data frame to file
     counts_table.to_csv(os.path.join(output_folder, filenameDataFrame), sep="\t", na_rep=0)       
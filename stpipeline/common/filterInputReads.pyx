@@ -6,10 +6,13 @@ import re
 import pysam
 import ctypes
 import logging
-from stpipeline.common.utils import safeOpenFile, fileOk, is_fifo
+import multiprocessing
+from collections import deque
+from stpipeline.common.utils import safeOpenFile, fileOk, is_fifo, prefetch
 from stpipeline.common.fastq_utils import *
+from stpipeline.common.cfastq_utils import high_content, find_homopolymers
 from stpipeline.common.sam_utils import convert_to_AlignedSegment
-from stpipeline.common.adaptors import removeAdaptor
+from stpipeline.common.adaptors import findAdaptors
 from stpipeline.common.stats import qa_stats
 
 bam_header = {
@@ -17,31 +20,241 @@ bam_header = {
         'RG': [{'ID': '0', 'SM' : 'unknown_sample', 'PL' : 'ILLUMINA' }]
     }
         
+# The settings used by filter_batch(), set with init_filter()
+_filter_settings = None
+
+def init_filter(settings):
+    """
+    Sets the settings used by filter_batch() in the current process
+    (it is also the initializer of the worker processes)
+    :param settings: the tuple of settings built in InputReadsFilter()
+    """
+    global _filter_settings
+    _filter_settings = settings
+
+def ordered_map(pool, function, iterable, int max_pending):
+    """
+    Like pool.imap() but the iterable is not consumed faster than 
+    the results are retrieved (at most max_pending tasks in the pool)
+    :param pool: the multiprocessing pool
+    :param function: the function to apply to every item
+    :param iterable: the items
+    :param max_pending: max number of tasks submitted to the pool
+    :return: yields the results in the same order as the items
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.apply_async(function, (item,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def filter_batch(list batch):
+    """
+    Applies the filters and the quality trimming to a batch of read pairs
+    using the settings given to init_filter()
+    :param batch: list of pairs of (header, sequence, quality) of R1 and R2
+    :return: a tuple with the reads that passed the filters (header, sequence,
+             quality, barcode, umi), the discarded R2 records, the list of
+             counters and true if a pair with an empty read was found
+    """
+    logger = logging.getLogger("STPipeline")
+    cdef int barcode_start, barcode_end, umi_start, umi_end
+    cdef int min_qual, min_length, phred, adaptor_missmatches
+    cdef int filter_AT_content, filter_GC_content, umi_quality_bases
+    cdef bint umi_filter, do_umi_quality, disable_umi, disable_barcode
+    cdef bint keep_discarded_files
+    cdef list adaptors
+    barcode_start, barcode_end, umi_start, umi_end, \
+    min_qual, min_length, phred, adaptors, adaptor_missmatches, \
+    filter_AT_content, filter_GC_content, umi_filter, umi_template, \
+    do_umi_quality, umi_quality_bases, disable_umi, disable_barcode, \
+    keep_discarded_files = _filter_settings
+    cdef bint do_AT_filter = filter_AT_content > 0
+    cdef bint do_GC_filter = filter_GC_content > 0
+
+    # Some counters
+    cdef int total_reads = 0
+    cdef int dropped_umi = 0
+    cdef int dropped_umi_template = 0
+    cdef int dropped_AT = 0
+    cdef int dropped_GC = 0
+    cdef int dropped_adaptor = 0
+    cdef int too_short_after_trimming = 0
+    cdef bint truncated = False
+    cdef list kept = []
+    cdef list discarded = []
+
+    # Some variables to avoid overhead in the loop
+    cdef bytes header_fw
+    cdef bytes sequence_fw
+    cdef bytes quality_fw
+    cdef bytes header_rv
+    cdef bytes name_rv
+    cdef bytes sequence_rv
+    cdef bytes quality_rv
+    cdef bytes orig_sequence_rv
+    cdef bytes orig_quality_rv
+    cdef bint discard_read
+    cdef Py_ssize_t num_bases_rv
+    cdef Py_ssize_t end_rv
+    cdef Py_ssize_t i
+    cdef Py_ssize_t j
+    cdef Py_ssize_t umi_qual_end
+    cdef int low_qual_bases
+
+    # Bind the functions used in the loop to local names
+    match_umi = umi_template.match if umi_filter else None
+
+    # Without miss-matches the homopolymers are found with a single scan
+    cdef bytes homopolymer_bases = bytes([adaptor[0] for adaptor in adaptors])
+    cdef tuple homopolymer_lengths = tuple([len(adaptor) for adaptor in adaptors])
+
+    # The slices are the same for every read so they are built only once
+    barcode_slice = slice(barcode_start, barcode_end)
+    umi_slice = slice(umi_start, umi_end)
+    _findAdaptors = findAdaptors
+    _find_homopolymers = find_homopolymers
+    _trim_quality = trim_quality
+    keep = kept.append
+    discard = discarded.append
+
+    # The AT and GC content of the reverse reads is computed for the whole batch
+    cdef list sequences_rv
+    cdef bytearray high_AT
+    cdef bytearray high_GC
+    if do_AT_filter or do_GC_filter:
+        sequences_rv = [pair[1][1] for pair in batch]
+        if do_AT_filter:
+            high_AT = high_content(sequences_rv, b"AT", filter_AT_content)
+        if do_GC_filter:
+            high_GC = high_content(sequences_rv, b"GC", filter_GC_content)
+
+    for i in range(len(batch)):
+        (header_fw, sequence_fw, quality_fw), \
+        (header_rv, sequence_rv, quality_rv) = batch[i]
+        
+        discard_read = False
+        orig_sequence_rv, orig_quality_rv = sequence_rv, quality_rv
+        total_reads += 1
+        
+        if not sequence_fw or not sequence_rv:
+            truncated = True
+            break
+
+        # Only the name (before the first space) is compared and used in the BAM
+        # (split only once as the rest of the header is not needed)
+        name_rv = header_rv.split(None, 1)[0]
+        if header_fw.split(None, 1)[0] != name_rv:
+            logger.warning("Pair reads found with different " \
+                                "names {} and {}".format(header_fw.decode(), header_rv.decode()))
+
+        # get the barcode sequence
+        if disable_barcode:
+            barcode = None
+        else:
+            barcode = sequence_fw[barcode_slice]
+
+        if not disable_umi:
+            # If we want to check for UMI quality and the UMI is incorrect
+            # then we discard the reads
+            umi_seq = sequence_fw[umi_slice]
+            if umi_filter and match_umi(umi_seq) is None:
+                dropped_umi_template += 1
+                discard_read = True
+
+            # Check if the UMI has many low quality bases
+            # (counted in the quality of the read without slicing the UMI)
+            if not discard_read and do_umi_quality:
+                low_qual_bases = 0
+                umi_qual_end = min(umi_end, len(quality_fw))
+                for j in range(umi_start, umi_qual_end):
+                    if (quality_fw[j] - phred) < min_qual:
+                        low_qual_bases += 1
+                if low_qual_bases > umi_quality_bases:
+                    dropped_umi += 1
+                    discard_read = True
+        else:
+            umi_seq = None
+
+        # If reverse read has a high AT content discard...
+        num_bases_rv = len(sequence_rv)
+        if not discard_read and do_AT_filter and high_AT[i]:
+            dropped_AT += 1
+            discard_read = True
+
+        # If reverse read has a high GC content discard...
+        if not discard_read and do_GC_filter and high_GC[i]:
+            dropped_GC += 1
+            discard_read = True
+
+        if not discard_read:
+            # Perform adaptor/homopolymer filters
+            # (reads can only get shorter so we can stop at the min length)
+            # Only the position where the read ends is updated and the
+            # read is sliced once after the quality trimming
+            end_rv = num_bases_rv
+            if num_bases_rv == len(quality_rv):
+                if adaptor_missmatches == 0:
+                    end_rv = _find_homopolymers(sequence_rv, homopolymer_bases, homopolymer_lengths,
+                                                num_bases_rv, min_length)
+                else:
+                    end_rv = _findAdaptors(sequence_rv, adaptors, adaptor_missmatches, 
+                                           num_bases_rv, min_length)
+
+            # Check if the read is smaller than the minimum after removing artifacts
+            if end_rv < min_length:
+                dropped_adaptor += 1
+                discard_read = True
+
+        if not discard_read:
+            # Trim reverse read (will return None if length of trimmed sequence is less than min_length)
+            sequence_rv, quality_rv = _trim_quality(
+                sequence_rv,
+                quality_rv,
+                min_qual,
+                min_length,
+                phred,
+                end_rv)
+            if not sequence_rv or not quality_rv:
+                too_short_after_trimming += 1
+                discard_read = True
+
+        if not discard_read:
+            keep((name_rv, sequence_rv, quality_rv, barcode, umi_seq))
+        elif keep_discarded_files:
+            discard((header_rv, orig_sequence_rv, orig_quality_rv))
+
+    return kept, discarded, [total_reads, dropped_umi, dropped_umi_template, dropped_AT,
+                             dropped_GC, dropped_adaptor, too_short_after_trimming], truncated
+
 def InputReadsFilter(fw,
                      rv,
                      out_rv,
                      out_rv_discarded,
-                     barcode_length,
-                     start_position,
-                     filter_AT_content,
-                     filter_GC_content,
-                     umi_start,
-                     umi_end,
-                     min_qual,
-                     min_length,
-                     polyA_min_distance,
-                     polyT_min_distance,
-                     polyG_min_distance,
-                     polyC_min_distance,
-                     polyN_min_distance,
-                     qual64,
-                     umi_filter,
+                     int barcode_length,
+                     int start_position,
+                     int filter_AT_content,
+                     int filter_GC_content,
+                     int umi_start,
+                     int umi_end,
+                     int min_qual,
+                     int min_length,
+                     int polyA_min_distance,
+                     int polyT_min_distance,
+                     int polyG_min_distance,
+                     int polyC_min_distance,
+                     int polyN_min_distance,
+                     bint qual64,
+                     bint umi_filter,
                      umi_filter_template,
-                     umi_quality_bases,
-                     adaptor_missmatches,
-                     overhang,
-                     disable_umi,
-                     disable_barcode):
+                     int umi_quality_bases,
+                     int adaptor_missmatches,
+                     int overhang,
+                     bint disable_umi,
+                     bint disable_barcode,
+                     int threads=1):
     """
     This class handles the input read filtering and quality trimming
       - It performs a sanity check (forward and reverse reads same length and order)
@@ -76,6 +289,7 @@ def InputReadsFilter(fw,
     :param overhang: overhang to be used for the barcodes (integer)
     :param disable_umi: true if the reads do not contain UMIs
     :param disable_barcode: true if the reads do not contain barcodes
+    :param threads: number of processes used to filter the reads
     """
     logger = logging.getLogger("STPipeline")
     if not (os.path.isfile(fw) or is_fifo(fw)) or not (os.path.isfile(rv) or is_fifo(rv)):
@@ -87,24 +301,42 @@ def InputReadsFilter(fw,
     cdef bint keep_discarded_files = out_rv_discarded is not None
 
     # Build fake sequence adaptors with the parameters given
-    cdef str adaptorA = "".join("A" for k in range(polyA_min_distance))
-    cdef str adaptorT = "".join("T" for k in range(polyT_min_distance))
-    cdef str adaptorG = "".join("G" for k in range(polyG_min_distance))
-    cdef str adaptorC = "".join("C" for k in range(polyC_min_distance))
-    cdef str adaptorN = "".join("N" for k in range(polyN_min_distance))
+    cdef bytes adaptorA = b"A" * polyA_min_distance
+    cdef bytes adaptorT = b"T" * polyT_min_distance
+    cdef bytes adaptorG = b"G" * polyG_min_distance
+    cdef bytes adaptorC = b"C" * polyC_min_distance
+    cdef bytes adaptorN = b"N" * polyN_min_distance
 
     # Not recommended to do adaptor trimming for adaptors smaller than 5
-    cdef bint do_adaptorA = polyA_min_distance >= 5
-    cdef bint do_adaptorT = polyT_min_distance >= 5
-    cdef bint do_adaptorG = polyG_min_distance >= 5
-    cdef bint do_adaptorC = polyC_min_distance >= 5
-    cdef bint do_adaptorN = polyN_min_distance >= 5
-    cdef bint do_AT_filter = filter_AT_content > 0
-    cdef bint do_GC_filter = filter_GC_content > 0
+    # so only the enabled adaptors are kept (in the order they are removed)
+    cdef list adaptors = [adaptor for adaptor, min_distance in ((adaptorA, polyA_min_distance),
+                                                                (adaptorT, polyT_min_distance),
+                                                                (adaptorG, polyG_min_distance),
+                                                                (adaptorC, polyC_min_distance),
+                                                                (adaptorN, polyN_min_distance))
+                          if min_distance >= 5]
 
     # Quality format
     cdef int phred = 64 if qual64 else 33
+
+    # Barcode position (including the overhang)
+    cdef int barcode_start = max(0, start_position - overhang)
+    cdef int barcode_end = start_position + barcode_length + overhang
+
+    # The UMI quality check is only done when the UMI is long enough
+    cdef bint do_umi_quality = (umi_end - umi_start) >= umi_quality_bases
+
+    # Reads are processed as bytes so the UMI template must be bytes too
+    # (the template is compiled only once)
+    umi_template = re.compile(umi_filter_template.encode()) if umi_filter else None
       
+    # The settings used by filter_batch()
+    settings = (barcode_start, barcode_end, umi_start, umi_end,
+                min_qual, min_length, phred, adaptors, adaptor_missmatches,
+                filter_AT_content, filter_GC_content, umi_filter, umi_template,
+                do_umi_quality, umi_quality_bases, disable_umi, disable_barcode,
+                keep_discarded_files)
+
     # Some counters
     cdef int total_reads = 0
     cdef int dropped_umi = 0
@@ -113,132 +345,61 @@ def InputReadsFilter(fw,
     cdef int dropped_GC = 0
     cdef int dropped_adaptor = 0
     cdef int too_short_after_trimming = 0
-          
-    # Some variables to avoid overhead in the loop
-    cdef str header_fw
-    cdef str sequence_fw
-    cdef str quality_fw
-    cdef str header_rv
-    cdef str sequence_rv
-    cdef str quality_rv
-    cdef str orig_sequence_rv
-    cdef str orig_quality_rv
-    cdef bint discard_read
     
     # Create output file writers
     bam_file = pysam.AlignmentFile(out_rv, "wbu", header=bam_header)
-    fw_file = safeOpenFile(fw, "rU")
-    rv_file = safeOpenFile(rv, "rU")
+    fw_file = safeOpenFile(fw, "rb")
+    rv_file = safeOpenFile(rv, "rb")
     if keep_discarded_files:
-        out_rv_handle_discarded = safeOpenFile(out_rv_discarded, 'w')
-        out_rv_writer_discarded = writefq(out_rv_handle_discarded)
-        
-    for (header_fw, sequence_fw, quality_fw), \
-    (header_rv, sequence_rv, quality_rv) in zip(readfq(fw_file), readfq(rv_file)):
-        
-        discard_read = False
-        orig_sequence_rv, orig_quality_rv = sequence_rv, quality_rv
-        total_reads += 1
-        
-        if not sequence_fw or not sequence_rv:
-            error = "Error doing quality trimming.\n" \
-            "The input files are not of the same length"
-            logger.error(error)
-            break
+        writer_discarded = FastqWriter(safeOpenFile(out_rv_discarded, 'wb'))
+        write_discarded = writer_discarded.write
 
-        if header_fw.split()[0] != header_rv.split()[0]:
-            logger.warning("Pair reads found with different " \
-                                "names {} and {}".format(header_fw,header_rv))
+    # Bind the functions used in the loop to local names
+    write_bam = bam_file.write
+    _convert_to_AlignedSegment = convert_to_AlignedSegment
 
-        # get the barcode sequence
-        if disable_barcode:
-            barcode = None
-        else:
-            barcode = sequence_fw[max(0,start_position-overhang):(start_position+barcode_length+overhang)]
+    # The input files are parsed in a separate thread (in batches of pairs)
+    # and the batches are filtered by a pool of workers if threads > 1
+    # (the pool is created before the parsing thread is started)
+    pool = None
+    init_filter(settings)
+    batches = prefetch(zip(readfq(fw_file), readfq(rv_file)))
+    if threads > 1:
+        pool = multiprocessing.Pool(threads, init_filter, (settings,))
+        results = ordered_map(pool, filter_batch, batches, 2 * threads)
+    else:
+        results = map(filter_batch, batches)
 
-        if not disable_umi:
-            # If we want to check for UMI quality and the UMI is incorrect
-            # then we discard the reads
-            umi_seq = sequence_fw[umi_start:umi_end]
-            if umi_filter \
-            and not check_umi_template(umi_seq, umi_filter_template):
-                dropped_umi_template += 1
-                discard_read = True
-
-            # Check if the UMI has many low quality bases
-            umi_qual = quality_fw[umi_start:umi_end]
-            if not discard_read and (umi_end - umi_start) >= umi_quality_bases and \
-            len([b for b in umi_qual if (ord(b) - phred) < min_qual]) > umi_quality_bases:
-                dropped_umi += 1
-                discard_read = True
-        else:
-            umi_seq = None
-
-        # If reverse read has a high AT content discard...
-        if not discard_read and do_AT_filter and \
-        ((sequence_rv.count("A") + sequence_rv.count("T")) / len(sequence_rv)) * 100 >= filter_AT_content:
-            dropped_AT += 1
-            discard_read = True
-
-        # If reverse read has a high GC content discard...
-        if not discard_read and do_GC_filter and \
-        ((sequence_rv.count("G") + sequence_rv.count("C")) / len(sequence_rv)) * 100 >= filter_GC_content:
-            dropped_GC += 1
-            discard_read = True
-
-        if not discard_read:
-            # Perform adaptor/homopolymer filters
-            if do_adaptorA and len(sequence_rv) > min_length:
-                sequence_rv, quality_rv = removeAdaptor(
-                    sequence_rv, quality_rv, adaptorA, adaptor_missmatches)
-            if do_adaptorT and len(sequence_rv) > min_length:
-                sequence_rv, quality_rv = removeAdaptor(
-                    sequence_rv, quality_rv, adaptorT, adaptor_missmatches)
-            if do_adaptorG and len(sequence_rv) > min_length:
-                sequence_rv, quality_rv = removeAdaptor(
-                    sequence_rv, quality_rv, adaptorG, adaptor_missmatches)
-            if do_adaptorC and len(sequence_rv) > min_length:
-                sequence_rv, quality_rv = removeAdaptor(
-                    sequence_rv, quality_rv, adaptorC, adaptor_missmatches)
-            if do_adaptorN and len(sequence_rv) > min_length:
-                sequence_rv, quality_rv = removeAdaptor(
-                    sequence_rv, quality_rv, adaptorN, adaptor_missmatches)
-
-            # Check if the read is smaller than the minimum after removing artifacts
-            if len(sequence_rv) < min_length:
-                dropped_adaptor += 1
-                discard_read = True
-
-        if not discard_read:
-            # Trim reverse read (will return None if length of trimmed sequence is less than min_length)
-            sequence_rv, quality_rv = trim_quality(
-                sequence_rv,
-                quality_rv,
-                min_qual,
-                min_length,
-                phred)
-            if not sequence_rv or not quality_rv:
-                too_short_after_trimming += 1
-                discard_read = True
-
-        if not discard_read:
-            bam_file.write(
-                convert_to_AlignedSegment(
-                    header_rv,
-                    sequence_rv,
-                    quality_rv,
-                    barcode,
-                    umi_seq))
-        elif keep_discarded_files:
-            out_rv_writer_discarded.send((header_rv, orig_sequence_rv, orig_quality_rv))
+    try:
+        # The results come in the same order as the input
+        for kept, discarded, stats, truncated in results:
+            for record in kept:
+                write_bam(_convert_to_AlignedSegment(*record))
+            if keep_discarded_files:
+                for record in discarded:
+                    write_discarded(record)
+            total_reads += stats[0]
+            dropped_umi += stats[1]
+            dropped_umi_template += stats[2]
+            dropped_AT += stats[3]
+            dropped_GC += stats[4]
+            dropped_adaptor += stats[5]
+            too_short_after_trimming += stats[6]
+            if truncated:
+                error = "Error doing quality trimming.\n" \
+                "The input files are not of the same length"
+                logger.error(error)
+                break
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
 
     bam_file.close()                    
     fw_file.close()
     rv_file.close()
     if keep_discarded_files:
-        out_rv_handle_discarded.flush()
-        out_rv_handle_discarded.close()
-        out_rv_writer_discarded.close()
+        writer_discarded.close()
                 
     # Write info to the log
     cdef int dropped_rv = dropped_umi + dropped_umi_template + \
@@ -246,7 +407,8 @@ def InputReadsFilter(fw,
                           too_short_after_trimming
     logger.info("Trimming stats total reads (pair): {}".format(total_reads))
     logger.info("Trimming stats {} reads have been dropped!".format(dropped_rv)) 
-    perc2 = '{percent:.2%}'.format(percent= float(dropped_rv) / float(total_reads) )
+    perc2 = '{percent:.2%}'.format(percent= float(dropped_rv) / float(total_reads) 
+                                   if total_reads > 0 else 0.0)
     logger.info("Trimming stats you just lost about {} of your data".format(perc2))
     logger.info("Trimming stats reads remaining: {}".format(total_reads - dropped_rv))
     logger.info("Trimming stats dropped pairs due to incorrect UMI: {}".format(dropped_umi_template))
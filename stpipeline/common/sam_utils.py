@@ -30,7 +30,7 @@ def split_bam(input_bamfile_name, temp_dir, threads):
    # Open the output bam files
     output_bamfiles = {
         part:pysam.AlignmentFile(file_name, mode="wbu", template=input_bamfile) \
-        for part, file_name in output_file_names.iteritems()
+        for part, file_name in output_file_names.items()
     }
 
     # Split the BAM file
@@ -69,7 +69,7 @@ def convert_to_AlignedSegment(header, sequence, quality,
 
     # Set the standard values
     # Header must not contain empty spaces
-    aligned_segment.query_name = header.split()[0]
+    aligned_segment.query_name = header.split(None, 1)[0]
     aligned_segment.query_sequence = sequence
     aligned_segment.query_qualities = pysam.qualitystring_to_array(quality)
 
@@ -65,7 +65,10 @@ class Stats():
         "\navergage_gene_feature: " + str(self.average_gene_feature) + \
         "\naverage_reads_feature: " + str(self.average_reads_feature)
         
-    def writeJSON(self, filename):
+    def toJSON(self):
+        """
+        Returns the stats as a JSON formatted string
+        """
         qa_parameters = {"input_reads_forward" : self.input_reads_forward,
                          "input_reads_reverse" : self.input_reads_reverse,
                          "reads_after_trimming_forward" : self.reads_after_trimming_forward,
@@ -91,9 +94,11 @@ class Stats():
                          "min_reads_unique_event" : self.min_reads_unique_event,
                          "avergage_gene_feature" : self.average_gene_feature,
                          "average_reads_feature" : self.average_reads_feature}
-                         
-                         
+
+        return json.dumps(qa_parameters, indent=2, separators=(',', ': '))
+    
+    def writeJSON(self, filename):
         with open(filename, "w") as filehandler:
-            json.dump(qa_parameters, filehandler, indent=2, separators=(',', ': '))
+            filehandler.write(self.toJSON())
    
 qa_stats = Stats()         
\ No newline at end of file
@@ -10,11 +10,52 @@ import logging
 import pysam
 import operator
 from collections import defaultdict
+from functools import lru_cache
 from pympler.asizeof import asizeof
 from stpipeline.common.utils import fileOk
 from stpipeline.common.stats import qa_stats
 from stpipeline.common.gff_reader import gff_lines
 
+@lru_cache(maxsize=4)
+def _gene_end_coordinates(str gff_filename, size, mtime):
+    """
+    Reads the end coordinate and chromosome of all the genes present in 
+    the GFF file (see geneBuffer). The size and modification time of the file
+    are part of the cache key so a modified file is parsed again.
+    The returned dictionary is shared and must not be modified.
+    """
+    # Create a dict with end coordinates for all genes
+    # to be able to tell when a gene is "processed"
+    # and thereby ready to be returned to the parent process
+    cdef dict gene_end_coordinates = dict()
+    cdef dict line
+    cdef str gene_id
+    cdef str seqname
+    cdef int end
+
+    # parse GTF file
+    for line in gff_lines(gff_filename):
+        seqname = line['seqname']
+        end = int(line['end'])
+        # save gene_id and rightmost genomic coordinate of each gene to dictionary
+        try:
+            gene_id = line['gene_id']
+            if gene_id[0] == '"' and gene_id[-1] == '"': 
+                gene_id = gene_id[1:-1]
+        except KeyError:
+            raise ValueError(
+                'The gene_id attribute is missing in the annotation file ({0})\n'.format(gff_filename)
+                )
+        try:
+            if end > gene_end_coordinates[gene_id][1]:
+                gene_end_coordinates[gene_id] = (seqname, end)
+        except KeyError:
+            gene_end_coordinates[gene_id] = (seqname, end)
+
+    # A fix to include any "__no_feature" annotations
+    gene_end_coordinates['__no_feature'] = (None,-1)
+    return gene_end_coordinates
+
 class geneBuffer():
     """
     This object defines a buffer by holding a dictionary 
@@ -39,38 +80,11 @@ class geneBuffer():
         function that reads the end coordinate and chromosomes of all the genes present
         in the GFF file and save them as values of a dictionary with the gene ID as key
         dict: [GENE_id] => (chromosome, gene_end_coordinate)
+        (the file is parsed only once when several datasets are created, i.e saturation)
         """
-        # Create a dict with end coordinates for all genes
-        # to be able to tell when a gene is "processed"
-        # and thereby ready to be returned to the parent process
-        cdef dict gene_end_coordinates = dict()
-        cdef dict line
-        cdef str gene_id
-        cdef str seqname
-        cdef int end
-
-        # parse GTF file
-        for line in gff_lines(gff_filename):
-            seqname = line['seqname']
-            end = int(line['end'])
-            gene_id = line['gene_id']
-            # save gene_id and rightmost genomic coordinate of each gene to dictionary
-            try:
-                if gene_id[0] == '"' and gene_id[-1] == '"': 
-                    gene_id = gene_id[1:-1]
-            except KeyError:
-                raise ValueError(
-                    'The gene_id attribute is missing in the annotation file ({0})\n'.format(self.gff_filename)
-                    )
-            try:
-                if end > gene_end_coordinates[gene_id][1]:
-                    gene_end_coordinates[gene_id] = (seqname, end)
-            except KeyError:
-                gene_end_coordinates[gene_id] = (seqname, end)
-
-        # A fix to include any "__no_feature" annotations
-        gene_end_coordinates['__no_feature'] = (None,-1)
-        self.gene_end_coordinates = gene_end_coordinates
+        self.gene_end_coordinates = _gene_end_coordinates(gff_filename, 
+                                                          os.path.getsize(gff_filename),
+                                                          os.path.getmtime(gff_filename))
 
     def get_gene_end_position(self, gene):
         """
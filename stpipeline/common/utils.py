@@ -6,33 +6,30 @@ from datetime import datetime
 import os
 import subprocess
 import stat
+import queue
+import itertools
+from functools import lru_cache
 
-def which_program(program):
-    """ 
-    Checks that a program exists and is executable
-    :param program: the program name
-    :type program: str
-    :return: The program name if the program is in the system and is executable
-    """
-    def is_exe(fpath):
-        return fpath is not None and os.path.exists(fpath) and os.access(fpath, os.X_OK)
-
-    def ext_candidates(fpath):
-        yield fpath
-        for ext in os.environ.get("PATHEXT", "").split(os.pathsep):
-            yield fpath + ext
-
-    fpath, fname = os.path.split(program)
-    if fpath:
-        if is_exe(program):
-            return program
-    else:
-        for path in os.environ["PATH"].split(os.pathsep):
-            exe_file = os.path.join(path, program)
-            for candidate in ext_candidates(exe_file):
-                if is_exe(candidate):
-                    return candidate
-    return None
+@lru_cache(maxsize=None)
+def available_programs():
+    """
+    Scans once the folders of the PATH and returns the names of
+    the executable programs found in them
+    :return: a frozenset with the names of the programs
+    """
+    programs = set()
+    for path in os.environ.get("PATH", "").split(os.pathsep):
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_file() and os.access(entry.path, os.X_OK):
+                            programs.add(entry.name)
+                    except OSError:
+                        continue
+        except OSError:
+            continue
+    return frozenset(programs)
              
 class TimeStamper(object):
     """
@@ -54,6 +51,85 @@ class TimeStamper(object):
                 self.count = 1
         return ts
 
+def prefetch(iterable, batch_size=4096, max_batches=16):
+    """
+    Consumes the given iterable in a background thread and
+    returns its elements in batches (lists) through a bounded queue
+    so reading the input overlaps with processing the batches.
+    Exceptions raised while consuming the iterable are re-raised
+    in the caller.
+    :param iterable: the iterable to consume
+    :param batch_size: the number of elements in each batch
+    :param max_batches: the max number of batches waiting in the queue
+    :type batch_size: int
+    :type max_batches: int
+    :return: an iterator over lists of elements
+    """
+    batches = queue.Queue(max_batches)
+    done = threading.Event()
+
+    def put(item):
+        # Give up if the consumer is gone
+        while not done.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def producer():
+        try:
+            it = iter(iterable)
+            while not done.is_set():
+                batch = list(itertools.islice(it, batch_size))
+                if not batch:
+                    break
+                put(batch)
+            put(None)
+        except Exception as e:
+            put(e)
+
+    thread = threading.Thread(target=producer)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            batch = batches.get()
+            if batch is None:
+                break
+            if isinstance(batch, Exception):
+                raise batch
+            yield batch
+    finally:
+        done.set()
+
+class BackgroundTask(object):
+    """
+    Runs a function in a background (daemon) thread so it
+    overlaps with other steps. The result (or the exception raised
+    by the function) is returned by result() which waits for the 
+    function to finish. Being a daemon thread it does not block the 
+    exit of the program if the caller fails before.
+    """
+    def __init__(self, function, *args, **kwargs):
+        self._result = None
+        self._error = None
+        self._thread = threading.Thread(target=self._run, args=(function, args, kwargs))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, function, args, kwargs):
+        try:
+            self._result = function(*args, **kwargs)
+        except Exception as e:
+            self._error = e
+
+    def result(self):
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
 def safeRemove(filename):
     """
     Safely remove a file
@@ -66,15 +142,17 @@ def safeRemove(filename):
     except UnboundLocalError:
         pass
         
-def safeOpenFile(filename, atrib):
+def safeOpenFile(filename, atrib, buffering=-1):
     """
     Safely opens a file
     For writing mode it removes the previous file if it exits
     For reading mode it check that the file exists
     :param filename: the path of the file
     :param atrib: the file open/write attribute
+    :param buffering: the buffer size (see open(), -1 for the default)
     :type filename: str
     :type atrib: str
+    :type buffering: int
     :return: the file descriptor
     :raises: IOError
     """
@@ -88,7 +166,7 @@ def safeOpenFile(filename, atrib):
     else:
         raise IOError("Error, incorrect attribute {}\n".format(atrib))
 
-    return open(filename, atrib)
+    return open(filename, atrib, buffering)
 
 def fileOk(_file):
     """
@@ -98,6 +176,38 @@ def fileOk(_file):
     """
     return _file is not None and os.path.isfile(_file) and not os.path.getsize(_file) == 0
         
+def getFreeSpace(path):
+    """
+    Returns the space available to the user in the file system of a path
+    :param path: the path of a folder
+    :type path: str
+    :return: the available space in bytes
+    """
+    info = os.statvfs(path)
+    return info.f_bavail * info.f_frsize
+
+def getPhysicalCores():
+    """
+    Returns the number of physical cores that the process can use
+    (hyper-threading siblings are counted once). It falls back to
+    the number of CPUs if the topology is not available (not Linux).
+    :return: the number of physical cores
+    """
+    try:
+        cpus = os.sched_getaffinity(0)
+    except AttributeError:
+        cpus = range(os.cpu_count() or 1)
+    cores = set()
+    for cpu in cpus:
+        topology = "/sys/devices/system/cpu/cpu{}/topology".format(cpu)
+        try:
+            with open(os.path.join(topology, "physical_package_id")) as package_file, \
+            open(os.path.join(topology, "core_id")) as core_file:
+                cores.add((package_file.read().strip(), core_file.read().strip()))
+        except (IOError, OSError):
+            return max(1, len(cpus))
+    return max(1, len(cores))
+
 def getSTARVersion():
     """
     Tries to find the STAR binary
@@ -109,52 +219,43 @@ def getSTARVersion():
         proc = subprocess.Popen(["STAR", "--version"], 
                                 stdout=subprocess.PIPE, 
                                 stderr=subprocess.PIPE,
-                                shell=False, close_fds=True)
+                                shell=False, close_fds=True,
+                                universal_newlines=True)
         (stdout, errmsg) = proc.communicate()
         version = stdout
     except Exception:
         version = "Not available"
     return version.rstrip()
 
-def getTaggdCountVersion():
+def getPackageVersion(package):
     """
-    Tries to find the Taggd binary
-    and makes a system call to get its
-    version and return it
+    Returns the version of the given installed Python package
+    using the package metadata (no system call is needed)
+    :param package: the name of the package
+    :return: the version or "Not available"
     """
-    version = ""
     try:
-        proc = subprocess.Popen(["pip", "show", "taggd"], 
-                                stdout=subprocess.PIPE, 
-                                stderr=subprocess.PIPE,
-                                shell=False, close_fds=True)
-        (stdout, errmsg) = proc.communicate()
-        for line in stdout.split("\n"):
-            if line.find("Version:") != -1:
-                version = str(line.split()[-1])
+        try:
+            from importlib.metadata import version
+            return version(package)
+        except ImportError:
+            # Python < 3.8
+            import pkg_resources
+            return pkg_resources.get_distribution(package).version
     except Exception:
-        version = "Not available"
-    return version.rstrip()
+        return "Not available"
+
+def getTaggdCountVersion():
+    """
+    Returns the version of the Taggd package
+    """
+    return getPackageVersion("taggd")
 
 def getHTSeqCountVersion():
     """
-    Tries to find the HTSeqCount binary
-    and makes a system call to get its
-    version and return it
+    Returns the version of the HTSeq package
     """
-    version = ""
-    try:
-        proc = subprocess.Popen(["pip", "show", "htseq"], 
-                                stdout=subprocess.PIPE, 
-                                stderr=subprocess.PIPE,
-                                shell=False, close_fds=True)
-        (stdout, errmsg) = proc.communicate()
-        for line in stdout.split("\n"):
-            if line.find("Version:") != -1:
-                version = str(line.split()[-1])
-    except Exception:
-        version = "Not available"
-    return version.rstrip()
+    return getPackageVersion("htseq")
 
 def is_fifo(file_name):
     """
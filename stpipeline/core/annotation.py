@@ -6,7 +6,7 @@ of ST mapped reads against a reference.
 import logging
 import os
 import pysam
-from stpipeline.common.utils import fileOk
+from stpipeline.common.utils import fileOk, BackgroundTask
 from stpipeline.common.stats import qa_stats
 from stpipeline.common.sam_utils import merge_bam, split_bam
 import itertools
@@ -29,6 +29,42 @@ def invert_strand( iv ):
         raise ValueError("Illegal strand")
     return iv2
 
+def load_features(gff_filename, stranded, feature_type, id_attribute):
+    """
+    Parses the features of the given type from the annotation file
+    (taken from count_reads_in_features() so it can be done in advance).
+    :param gff_filename: path to the annotation file (GTF/GFF)
+    :param stranded: the type of strandness (yes, no or reverse)
+    :param feature_type: the type of features to load (exon)
+    :param id_attribute: the attribute used as the name of the features
+    :return: a HTSeq.GenomicArrayOfSets with the features
+    :raises: RuntimeError, ValueError
+    """
+    features = HTSeq.GenomicArrayOfSets("auto", stranded != "no")
+    counts = {}
+    gff = HTSeq.GFF_Reader(gff_filename)   
+
+    try:
+        for f in gff:
+            if f.type == feature_type:
+                try:
+                    feature_id = f.attr[id_attribute]
+                except KeyError:
+                    raise ValueError("Feature %s does not contain a '%s' attribute" \
+                                       % (f.name, id_attribute))
+                if stranded != "no" and f.iv.strand == ".":
+                    raise ValueError("Feature %s at %s does not have strand information but you are " \
+                                       "running htseq-count in stranded mode. Use '--stranded=no'." % 
+                                       (f.name, f.iv))
+                features[f.iv] += feature_id
+                counts[f.attr[id_attribute]] = 0
+    except:
+        raise
+    
+    if len(counts) == 0:
+        raise RuntimeError("No features of type '%s' found.\n" % feature_type)
+    return features
+
 def count_reads_in_features(sam_filename, 
                             gff_filename, 
                             samtype,
@@ -41,7 +77,8 @@ def count_reads_in_features(sam_filename,
                             samout, 
                             include_non_annotated, 
                             htseq_no_ambiguous,
-                            outputDiscarded):
+                            outputDiscarded,
+                            features=None):
     """
     This is taken from the function count_reads_in_features() from the 
     script htseq-count in the HTSeq package version 0.70 
@@ -51,6 +88,7 @@ def count_reads_in_features(sam_filename,
     to the HTSeq team.
     The description of the parameters are the same as htseq-count.
     Two parameters were added to filter out what to write in the sam output
+    The features can be given already loaded with load_features()
     
     The HTSEQ License
     HTSeq is free software: you can redistribute it and/or modify it under the terms of 
@@ -101,29 +139,8 @@ def count_reads_in_features(sam_filename,
             count_reads_in_features.samdiscarded.write(sam_record)
                 
     # Annotation objects
-    features = HTSeq.GenomicArrayOfSets("auto", stranded != "no")
-    counts = {}
-    gff = HTSeq.GFF_Reader(gff_filename)   
-
-    try:
-        for f in gff:
-            if f.type == feature_type:
-                try:
-                    feature_id = f.attr[id_attribute]
-                except KeyError:
-                    raise ValueError("Feature %s does not contain a '%s' attribute" \
-                                       % (f.name, id_attribute))
-                if stranded != "no" and f.iv.strand == ".":
-                    raise ValueError("Feature %s at %s does not have strand information but you are " \
-                                       "running htseq-count in stranded mode. Use '--stranded=no'." % 
-                                       (f.name, f.iv))
-                features[f.iv] += feature_id
-                counts[f.attr[id_attribute]] = 0
-    except:
-        raise
-    
-    if len(counts) == 0:
-        raise RuntimeError("No features of type '%s' found.\n" % feature_type)
+    if features is None:
+        features = load_features(gff_filename, stranded, feature_type, id_attribute)
         
     if samtype == "sam":
         SAM_or_BAM_Reader = HTSeq.SAM_Reader
@@ -203,7 +220,8 @@ def annotateReads(mappedReads,
                   htseq_no_ambiguous, 
                   include_non_annotated,
                   temp_dir,
-                  threads):
+                  threads,
+                  features=None):
     """
     Annotates a file with mapped reads (BAM) using a modified 
     version of the htseq-count tool. It writes the annotated records to a file.
@@ -221,6 +239,9 @@ def annotateReads(mappedReads,
     :param outputFile: the name/path to the output file
     :param temp_dir: path to the folder where to put the created files
     :param threads: the number of CPU cores to use
+    :param features: the features of the annotation file if they were
+    already loaded with load_features() or the BackgroundTask loading
+    them (the file is parsed if None)
     :type mappedReads: str
     :type gtfFile: str
     :type outputFile: str
@@ -243,6 +264,9 @@ def annotateReads(mappedReads,
         raise RuntimeError(error)
     
     try:
+        # Wait for the features loaded in the background (if any)
+        if isinstance(features, BackgroundTask):
+            features = features.result()
         annotated = count_reads_in_features(mappedReads,
                                             gtfFile,
                                             "bam", # Type BAM for filesz
@@ -255,7 +279,8 @@ def annotateReads(mappedReads,
                                             outputFile,
                                             include_non_annotated,
                                             htseq_no_ambiguous,
-                                            outputDiscarded)
+                                            outputDiscarded,
+                                            features)
     except Exception as e:
         error = "Error during annotation. HTSEQ execution failed\n"
         logger.error(error)
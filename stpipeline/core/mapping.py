@@ -5,10 +5,11 @@ demultiplexing in the ST pipeline
 import logging 
 import subprocess
 from subprocess import CalledProcessError
-from stpipeline.common.utils import fileOk
+from stpipeline.common.utils import fileOk, safeRemove
 from stpipeline.common.stats import qa_stats
 import os
 import shutil
+from collections import deque
 
 def alignReads(reverse_reads, 
                ref_map,
@@ -26,7 +27,8 @@ def alignReads(reverse_reads,
                min_length,
                include_non_mapped,
                star_genome_loading,
-               star_sort_mem_limit):
+               star_sort_mem_limit,
+               sort_output=True):
     """
     This function will perform a sequence alignment using STAR.
     Mapped and unmapped reads are written to the paths given as
@@ -50,6 +52,7 @@ def alignReads(reverse_reads,
     :param include_non_mapped: True to include un-aligned reads in the output
     :param star_genome_loading: The type of genome sharing for STAR
     :param star_sort_mem_limit: The BAM sort memory limit for STAR
+    :param sort_output: True to sort the output BAM by coordinate
     :type reverse_reads: str
     :type ref_map: str
     :type outputFile: str
@@ -67,6 +70,7 @@ def alignReads(reverse_reads,
     :type include_non_mapped: bool
     :type star_genome_loading: str
     :type star_sort_mem_limit: int
+    :type sort_output: bool
     :raises: RuntimeError,ValueError,OSError,CalledProcessError
     """
     logger = logging.getLogger("STPipeline")
@@ -77,7 +81,7 @@ def alignReads(reverse_reads,
         raise RuntimeError(error)
     
     # STAR has predefined output names for the files
-    tmpOutputFile = "Aligned.sortedByCoord.out.bam"
+    tmpOutputFile = "Aligned.sortedByCoord.out.bam" if sort_output else "Aligned.out.bam"
     tmpOutputFileDiscarded = "Unmapped.out.mate1"
     log_std = "Log.std.out"
     log = "Log.out"
@@ -101,7 +105,7 @@ def alignReads(reverse_reads,
              "--clip5pNbases", trimReverse,
              "--runThreadN", str(max(cores, 1)),
              "--outFilterType", "Normal", 
-             "--outSAMtype", "BAM", "SortedByCoordinate",
+             "--outSAMtype", "BAM", "SortedByCoordinate" if sort_output else "Unsorted",
              "--alignEndsType", alignment_mode,
              "--outSAMorder", "Paired",    
              "--outSAMprimaryFlag", "OneBestScore", 
@@ -114,14 +118,18 @@ def alignReads(reverse_reads,
              "--readMatesLengthsIn", "NotEqual",
              "--outFilterMismatchNoverLmax", 0.1, ## (0.3 default)
              "--genomeLoad", star_genome_loading,
-             "--limitBAMsortRAM", star_sort_mem_limit,
              "--readFilesType", "SAM","SE", # Input in BAM format
              "--readFilesCommand", "samtools", "view", "-h"] 
     
+    if sort_output:
+        flags += ["--limitBAMsortRAM", star_sort_mem_limit]
+        
     if twopassMode:
         flags += ["--twopassMode", "Basic"]
 
-    if annotation is not None:
+    # STAR does not allow to insert the junctions on the fly 
+    # in a genome index that is loaded in shared memory
+    if annotation is not None and star_genome_loading == "NoSharedMemory":
         flags += ["--sjdbGTFfile", annotation]
        
     if include_non_mapped:
@@ -137,9 +145,18 @@ def alignReads(reverse_reads,
     
     try:
         proc = subprocess.Popen([str(i) for i in args],
-                                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                bufsize=1, universal_newlines=True,
                                 close_fds=True, shell=False)
-        (stdout, errmsg) = proc.communicate()
+        # STAR writes its progress to the log files, the few lines
+        # it prints are logged as they arrive
+        errmsg = deque(maxlen=50)
+        for line in proc.stdout:
+            line = line.rstrip()
+            logger.debug(line)
+            errmsg.append(line)
+        returncode = proc.wait()
+        errmsg = "\n".join(errmsg)
     except ValueError as e:
         logger.error("Error mapping with STAR\n Incorrect arguments.")
         raise e
@@ -150,14 +167,17 @@ def alignReads(reverse_reads,
         logger.error("Error mapping with STAR\n Program returned error.")
         raise e
         
+    if returncode != 0:
+        error = "Error mapping with STAR.\n" \
+        "STAR returned the error code {}\n{}\n".format(returncode, errmsg)
+        logger.error(error)
+        raise RuntimeError(error)
+
     if not fileOk(tmpOutputFile):
         error = "Error mapping with STAR.\n" \
         "Output file not present {}\n{}\n".format(tmpOutputFile, errmsg)
         logger.error(error)
         raise RuntimeError(error)
-
-    if len(errmsg) > 0:
-        logger.warning("STAR has generated error messages during mapping.\n{}\n".format(errmsg))
         
     # Rename output files.
     shutil.move(tmpOutputFile, outputFile)
@@ -195,6 +215,42 @@ def alignReads(reverse_reads,
     # Remove log file       
     if os.path.isfile(log_final): os.remove(log_final)
 
+def releaseGenome(ref_map, outputFolder):
+    """
+    This function removes a genome index that was loaded 
+    in shared memory by STAR (--genomeLoad LoadAndKeep).
+    :param ref_map: a path to the genome/transcriptome STAR index
+    :param outputFolder: the path of the folder where STAR writes its logs
+    :type ref_map: str
+    :type outputFolder: str
+    :raises: RuntimeError,OSError
+    """
+    logger = logging.getLogger("STPipeline")
+    
+    prefix = outputFolder + os.sep if outputFolder is not None else ""
+    args = ["STAR",
+            "--genomeDir", ref_map,
+            "--genomeLoad", "Remove",
+            "--outFileNamePrefix", prefix]
+    try:
+        proc = subprocess.Popen([str(i) for i in args],
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                universal_newlines=True,
+                                close_fds=True, shell=False)
+        (errmsg, _) = proc.communicate()
+    except OSError as e:
+        logger.error("Error removing the genome from shared memory with STAR\n Executable not found.")
+        raise e
+    
+    if proc.returncode != 0:
+        error = "Error removing the genome {} from shared memory with STAR.\n" \
+        "STAR returned the error code {}\n{}\n".format(ref_map, proc.returncode, errmsg)
+        logger.error(error)
+        raise RuntimeError(error)
+    
+    # Remove the log file from STAR
+    safeRemove(prefix + "Log.out")
+    
 def barcodeDemultiplexing(reads, 
                           idFile,
                           mismatches,
@@ -222,6 +278,8 @@ def barcodeDemultiplexing(reads,
     :param taggd_metric: the distance metric algorithm (Subglobal, Levensthein or Hamming)
     :param taggd_multiple_hits_keep_one: when True keep one random hit when multiple candidates
     :param taggd_trim_sequences: coordinates to trim in the barcode
+    :param cores: the number of Taggd subprocesses (the input is split in chunks
+                  that are demultiplexed in parallel and merged by Taggd)
     :param outputFilePrefix: location and prefix for the output files
     :param keep_discarded_files: if True files with the non demultiplexed reads will be generated
     :type reads: str
@@ -233,6 +291,7 @@ def barcodeDemultiplexing(reads,
     :type taggd_metric: str
     :type taggd_multiple_hits_keep_one: bool
     :type taggd_trim_sequences: list
+    :type cores: int
     :type outputFilePrefix: str
     :type keep_discarded_files: bool
     :raises: RuntimeError,ValueError,OSError,CalledProcessError
@@ -268,7 +327,7 @@ def barcodeDemultiplexing(reads,
             "--barcode-tag", "B0", # if input is BAM we tell taggd what tag contains the barcode
             "--start-position", start_positon,
             "--homopolymer-filter", 0,
-            "--subprocesses", cores,
+            "--subprocesses", max(cores, 1),
             "--metric", taggd_metric,
             "--overhang", over_hang] #,
             #'--use-samtools-merge'] # Could be added to merge using samtools instead of pysam WIP on taggd
@@ -283,11 +342,27 @@ def barcodeDemultiplexing(reads,
         
     args += [idFile, reads, outputFilePrefix]
 
+    stats_keys = ("Total reads:", "Perfect Matches:", "Imperfect Matches",
+                  "Ambiguous matches:", "Non-unique ambiguous matches:", "Unmatched:")
     try:
         proc = subprocess.Popen([str(i) for i in args], 
-                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, 
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                bufsize=1, universal_newlines=True,
                                 close_fds=True, shell=False)
-        (stdout, errmsg) = proc.communicate()
+        # The stats are logged as Taggd prints them and only the 
+        # last lines are kept in memory to report errors
+        logger.info("Demultiplexing Mapping stats:")
+        errmsg = deque(maxlen=50)
+        for line in proc.stdout:
+            line = line.rstrip()
+            errmsg.append(line)
+            if line.find("Total reads written:") != -1:
+                logger.info(line)
+                qa_stats.reads_after_demultiplexing = line.split()[-1]
+            elif any(line.find(key) != -1 for key in stats_keys):
+                logger.info(line)
+        returncode = proc.wait()
+        errmsg = "\n".join(errmsg)
     except ValueError as e:
         logger.error("Error demultiplexing with TAGGD\n Incorrect arguments.")
         raise e
@@ -298,6 +373,12 @@ def barcodeDemultiplexing(reads,
         logger.error("Error demultiplexing with TAGGD\n Program returned error.")
         raise e
     
+    if returncode != 0:
+        error = "Error demultiplexing with TAGGD.\n" \
+        "Taggd returned the error code {}\n{}\n".format(returncode, errmsg)
+        logger.error(error)
+        raise RuntimeError(error)
+        
     # We know the output file from the prefix and suffix
     outputFile = "{}_matched{}".format(outputFilePrefix, os.path.splitext(reads)[1].lower())
     if not fileOk(outputFile):
@@ -306,26 +387,3 @@ def barcodeDemultiplexing(reads,
         logger.error(error)
         raise RuntimeError(error)
  
-    if len(errmsg) > 0:
-        logger.warning("Taggd has generated error messages during " \
-                       "demultiplexing.\n{}\n".format(errmsg))
-           
-    # TODO must be a cleaner way to get the stats from the output file
-    procOut = stdout.decode().split("\n")
-    logger.info("Demultiplexing Mapping stats:")
-    for line in procOut: 
-        if line.find("Total reads:") != -1:
-            logger.info(str(line))
-        if line.find("Total reads written:") != -1:
-            logger.info(str(line))
-            qa_stats.reads_after_demultiplexing = line.split()[-1]
-        if line.find("Perfect Matches:") != -1:
-            logger.info(str(line))
-        if line.find("Imperfect Matches") != -1:
-            logger.info(str(line))
-        if line.find("Ambiguous matches:") != -1:
-            logger.info(str(line))
-        if line.find("Non-unique ambiguous matches:") != -1:
-            logger.info(str(line))
-        if line.find("Unmatched:") != -1:
-            logger.info(str(line))
\ No newline at end of file
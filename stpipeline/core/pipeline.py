@@ -6,8 +6,8 @@ do sanity check and ultimately run the pipeline.
 """
 
 from stpipeline.common.utils import *
-from stpipeline.core.mapping import alignReads, barcodeDemultiplexing
-from stpipeline.core.annotation import annotateReads
+from stpipeline.core.mapping import alignReads, barcodeDemultiplexing, releaseGenome
+from stpipeline.core.annotation import annotateReads, load_features
 from stpipeline.common.stats import qa_stats
 from stpipeline.common.dataset import createDataset
 from stpipeline.common.saturation import computeSaturation
@@ -23,6 +23,10 @@ import tempfile
 import subprocess
 import pysam
 import inspect
+import signal
+import hashlib
+import json
+from concurrent.futures import ThreadPoolExecutor
 
 FILENAMES = {"mapped" : "mapped.bam",
              "annotated" : "annotated.bam",
@@ -39,6 +43,79 @@ FILENAMES_DISCARDED = {"mapped_discarded" : "mapping_discarded.bam",
                        "quality_trimmed_discarded" : "R2_quality_trimmed_discarded.fastq",
                        "annotated_discarded": "annotated_discarded.bam"}
 
+# The QA stats computed in the steps that can be skipped when resuming a run
+CHECKPOINT_STATS = ["input_reads_forward",
+                    "input_reads_reverse",
+                    "reads_after_trimming_forward",
+                    "reads_after_trimming_reverse",
+                    "reads_after_demultiplexing",
+                    "reads_after_annotation"]
+
+# The memory backed folder used for the temporary files (--temp-in-memory)
+MEMORY_FOLDER = "/dev/shm"
+# Conservative ratio of the decompressed to the compressed size of
+# the .gz/.bz2 input files (used to estimate the temporary space)
+COMPRESSED_FASTQ_RATIO = 8
+
+# IUPAC nucleotide codes to the reg-exp class used by the UMI filter
+IUPAC_TO_REGEX = {"A" : "[A]", "C" : "[C]", "G" : "[G]", "T" : "[T]", "U" : "[U]",
+                  "W" : "[AT]", "S" : "[CG]", "N" : "[ATCG]", "V" : "[ACG]",
+                  "R" : "[AG]", "Y" : "[CT]", "K" : "[GT]", "M" : "[AC]",
+                  "B" : "[CGT]", "D" : "[AGT]", "H" : "[ACT]"}
+
+# Pairs of (attribute, option) of the input parameters that are
+# loaded without any conversion (see Pipeline.load_parameters())
+INPUT_OPTIONS = [("allowed_missed", "allowed_missed"),
+                 ("allowed_kmer", "allowed_kmer"),
+                 ("overhang", "overhang"),
+                 ("min_length_trimming", "min_length_qual_trimming"),
+                 ("trimming_rv", "mapping_rv_trimming"),
+                 ("min_quality_trimming", "min_quality_trimming"),
+                 ("resume", "resume"),
+                 ("barcode_start", "start_id"),
+                 ("threads", "mapping_threads"),
+                 ("verbose", "verbose"),
+                 ("expName", "expName"),
+                 ("htseq_mode", "htseq_mode"),
+                 ("htseq_no_ambiguous", "htseq_no_ambiguous"),
+                 ("qual64", "qual_64"),
+                 ("contaminant_index", "contaminant_index"),
+                 ("temp_in_memory", "temp_in_memory"),
+                 ("umi_allowed_mismatches", "umi_allowed_mismatches"),
+                 ("umi_start_position", "umi_start_position"),
+                 ("umi_end_position", "umi_end_position"),
+                 ("keep_discarded_files", "keep_discarded_files"),
+                 ("remove_polyA_distance", "remove_polyA"),
+                 ("remove_polyT_distance", "remove_polyT"),
+                 ("remove_polyG_distance", "remove_polyG"),
+                 ("remove_polyC_distance", "remove_polyC"),
+                 ("remove_polyN_distance", "remove_polyN"),
+                 ("filter_AT_content", "filter_AT_content"),
+                 ("filter_GC_content", "filter_GC_content"),
+                 ("disable_multimap", "disable_multimap"),
+                 ("disable_clipping", "disable_clipping"),
+                 ("umi_cluster_algorithm", "umi_cluster_algorithm"),
+                 ("min_intron_size", "min_intron_size"),
+                 ("max_intron_size", "max_intron_size"),
+                 ("umi_filter", "umi_filter"),
+                 ("compute_saturation", "compute_saturation"),
+                 ("include_non_annotated", "include_non_annotated"),
+                 ("inverse_trimming_rv", "inverse_mapping_rv_trimming"),
+                 ("two_pass_mode", "two_pass_mode"),
+                 ("strandness", "strandness"),
+                 ("umi_quality_bases", "umi_quality_bases"),
+                 ("umi_counting_offset", "umi_counting_offset"),
+                 ("taggd_metric", "demultiplexing_metric"),
+                 ("taggd_multiple_hits_keep_one", "demultiplexing_multiple_hits_keep_one"),
+                 ("taggd_trim_sequences", "demultiplexing_trim_sequences"),
+                 ("adaptor_missmatches", "homopolymer_mismatches"),
+                 ("star_genome_loading", "star_genome_loading"),
+                 ("star_release_genome", "star_release_genome"),
+                 ("star_sort_mem_limit", "star_sort_mem_limit"),
+                 ("disable_barcode", "disable_barcode"),
+                 ("disable_umi", "disable_umi"),
+                 ("transcriptome", "transcriptome")]
+
 class Pipeline():
     """ This class contains all the ST pipeline
     attributes and a bunch of methods to parse
@@ -57,6 +134,7 @@ class Pipeline():
         self.clean = True
         self.barcode_start = 0
         self.threads = 8
+        self.star_threads = 8
         self.verbose = False
         self.ids = None
         self.ref_map = None
@@ -102,16 +180,149 @@ class Pipeline():
         self.taggd_trim_sequences = None
         self.adaptor_missmatches = 0
         self.star_genome_loading = "NoSharedMemory"
+        self.star_release_genome = False
         self.star_sort_mem_limit = 0
         self.disable_umi = False
         self.disable_barcode = False
         self.transcriptome = False
         self.saturation_points = None
+        self.resume = False
+        self.temp_in_memory = False
+        # True when the temp folder was created in MEMORY_FOLDER
+        # (it is always removed at the end to release the memory)
+        self._memory_temp_folder = False
+        # The intermediate files are removed in the background
+        # while the next steps are running
+        self._cleanup_pool = ThreadPoolExecutor(max_workers=2)
         
+    def remove_intermediate(self, file_name):
+        """ Removes (in the background) an intermediate
+        file that is not needed by the next steps
+        """
+        if self.clean:
+            self._cleanup_pool.submit(safeRemove, file_name)
+            
+    def checkpoint_steps(self):
+        """ Returns the steps that can be skipped when resuming
+        a run as a list of (name, digest, output files). The digest
+        of a step is computed from its parameters and the digest of
+        the previous step so a change invalidates the next steps too
+        """
+        def digest(*parameters):
+            return hashlib.sha1(repr(parameters).encode()).hexdigest()
+        
+        def file_stamp(file_name):
+            return (file_name, os.path.getsize(file_name), os.path.getmtime(file_name)) \
+            if file_name is not None and os.path.isfile(file_name) else file_name
+        
+        steps = []
+        step_digest = digest(version_number,
+                             file_stamp(self.fastq_fw), file_stamp(self.fastq_rv), 
+                             file_stamp(self.ids), self.barcode_start, 
+                             self.filter_AT_content, self.filter_GC_content,
+                             self.umi_start_position, self.umi_end_position,
+                             self.min_quality_trimming, self.min_length_trimming,
+                             self.remove_polyA_distance, self.remove_polyT_distance,
+                             self.remove_polyG_distance, self.remove_polyC_distance,
+                             self.remove_polyN_distance, self.qual64, self.umi_filter,
+                             self.umi_filter_template, self.umi_quality_bases,
+                             self.adaptor_missmatches, self.overhang,
+                             self.disable_umi, self.disable_barcode)
+        steps.append(("filtering", step_digest, [FILENAMES["quality_trimmed_R2"]]))
+        if self.contaminant_index:
+            step_digest = digest(step_digest, self.contaminant_index, 
+                                 self.trimming_rv, self.inverse_trimming_rv,
+                                 self.min_length_trimming)
+            steps.append(("contaminant_filter", step_digest, [FILENAMES["contaminated_clean"]]))
+        step_digest = digest(step_digest, self.ref_map, file_stamp(self.ref_annotation),
+                             self.trimming_rv, self.inverse_trimming_rv,
+                             self.min_intron_size, self.max_intron_size,
+                             self.disable_multimap, self.disable_clipping,
+                             self.two_pass_mode, self.min_length_trimming,
+                             self.keep_discarded_files, self.star_genome_loading)
+        steps.append(("mapping", step_digest, [FILENAMES["mapped"]]))
+        if not self.disable_barcode:
+            step_digest = digest(step_digest, self.allowed_missed, self.allowed_kmer,
+                                 self.overhang, self.taggd_metric,
+                                 self.taggd_multiple_hits_keep_one,
+                                 self.taggd_trim_sequences, self.keep_discarded_files)
+            steps.append(("demultiplexing", step_digest, [FILENAMES["demultiplexed_matched"]]))
+        step_digest = digest(step_digest, self.transcriptome, self.htseq_mode, 
+                             self.strandness, self.htseq_no_ambiguous,
+                             self.include_non_annotated, self.keep_discarded_files)
+        steps.append(("annotation", step_digest, [FILENAMES["annotated"]]))
+        return steps
+    
+    @staticmethod
+    def output_stamps(outputs):
+        """ Returns the (size, modification time) of the output
+        files of a step to detect when they are overwritten
+        """
+        return [[os.path.getsize(f), os.path.getmtime(f)] if fileOk(f) else None for f in outputs]
+    
+    def load_checkpoints(self, steps):
+        """ Finds the last step completed by a previous run with the 
+        same parameters (the checkpoints are in the temp folder),
+        restores its QA stats and returns the names of the steps
+        that can be skipped
+        """
+        skipped = set()
+        last_checkpoint = None
+        # Without --resume all the steps run (and their checkpoints are removed)
+        for i, (step, digest, outputs) in enumerate(steps if self.resume else []):
+            try:
+                with open(os.path.join(self.temp_folder, step + ".done")) as filehandler:
+                    checkpoint = json.load(filehandler)
+            except (IOError, ValueError):
+                continue
+            if checkpoint.get("digest") == digest \
+            and checkpoint.get("outputs") == self.output_stamps(outputs) \
+            and all(fileOk(f) for f in outputs):
+                skipped = set(name for name, _, _ in steps[:i + 1])
+                last_checkpoint = checkpoint
+        # The checkpoints of the steps that run again are removed so an 
+        # interrupted step (or a step run without --resume that overwrites
+        # the outputs) is never taken as completed
+        for step, _, _ in steps:
+            if step not in skipped:
+                safeRemove(os.path.join(self.temp_folder, step + ".done"))
+        if last_checkpoint is not None:
+            for key, value in list(last_checkpoint["stats"].items()):
+                setattr(qa_stats, key, value)
+            self.logger.info("Resuming the run, skipping the steps: {}".format(
+                ", ".join(name for name, _, _ in steps if name in skipped)))
+        return skipped
+    
+    def save_checkpoint(self, step, steps):
+        """ Writes the checkpoint of a completed step
+        with its digest and the QA stats computed so far
+        """
+        if not self.resume:
+            return
+        digest, outputs = dict((name, (value, files)) for name, value, files in steps)[step]
+        checkpoint = {"digest" : digest,
+                      "outputs" : self.output_stamps(outputs),
+                      "stats" : dict((key, getattr(qa_stats, key)) for key in CHECKPOINT_STATS)}
+        with open(os.path.join(self.temp_folder, step + ".done"), "w") as filehandler:
+            json.dump(checkpoint, filehandler)
+            
     def clean_filenames(self):
         """ Just makes sure to remove
-        all temp files
+        all temp files and to release the
+        genome indexes from the shared memory
         """
+        # Wait for the files being removed in the background
+        self._cleanup_pool.shutdown(wait=True)
+        if self.star_release_genome and self.star_genome_loading == "LoadAndKeep":
+            for genome in [self.contaminant_index, self.ref_map]:
+                if genome is None:
+                    continue
+                try:
+                    releaseGenome(genome, self.temp_folder)
+                except Exception as e:
+                    # Release the other indexes and the temp files anyway
+                    self.logger.warning("The genome {} could not be released " \
+                                        "from the shared memory.\n{}".format(genome, e))
         if self.clean:
             for file_name in list(FILENAMES.values()):
                 safeRemove(file_name)
@@ -127,7 +338,19 @@ class Pipeline():
                 shutil.rmtree(star_temp1)
             if os.path.isdir(star_temp2):
                 shutil.rmtree(star_temp2)
-            if self.clean and not self.keep_discarded_files \
+            if self._memory_temp_folder:
+                # The discarded files must be kept out of the memory (only the ones
+                # in the temp folder, the names are relative when run() did not start)
+                try:
+                    if self.keep_discarded_files:
+                        for file_name in list(FILENAMES_DISCARDED.values()):
+                            if os.path.isfile(file_name) and \
+                            os.path.dirname(os.path.abspath(file_name)) == self.temp_folder:
+                                shutil.move(file_name, os.path.join(self.output_folder, 
+                                                                    os.path.basename(file_name)))
+                finally:
+                    shutil.rmtree(self.temp_folder, ignore_errors=True)
+            elif self.clean and not self.keep_discarded_files \
             and self.temp_folder != self.output_folder:
                 shutil.rmtree(self.temp_folder)
           
@@ -136,30 +359,26 @@ class Pipeline():
         Performs some basic sanity checks on the input parameters
         """
 
-        if self.ref_annotation is not None and (not os.path.isfile(self.ref_annotation) or \
-        (not self.ref_annotation.endswith(".gtf") \
-        and not self.ref_annotation.endswith(".gff3") \
-        and not self.ref_annotation.endswith(".gff"))):
-            error = "Error parsing parameters.\n" \
-            "Invalid annotation file {}".format(self.ref_annotation)
-            self.logger.error(error)
-            raise RuntimeError(error)
-        
+        # The cheap checks on the parameters go first and the 
+        # checks that access the file system go at the end
         if self.ref_annotation is None and not self.transcriptome:
             error = "Error, annotation file is missing and the transcriptome option is disabled\n"
             self.logger.error(error)
             raise RuntimeError(error)
           
-        if not os.path.isfile(self.fastq_fw) or not os.path.isfile(self.fastq_rv):
+        if self.ref_annotation is not None \
+        and not self.ref_annotation.endswith(".gtf") \
+        and not self.ref_annotation.endswith(".gff3") \
+        and not self.ref_annotation.endswith(".gff"):
             error = "Error parsing parameters.\n" \
-            "Invalid input files {} {}".format(self.fastq_fw, self.fastq_rv)
+            "Invalid annotation file {}".format(self.ref_annotation)
             self.logger.error(error)
             raise RuntimeError(error)
-                     
+        
         if (not self.fastq_fw.endswith(".fastq") \
         and not self.fastq_fw.endswith(".fq") \
         and not self.fastq_fw.endswith(".gz") \
-        and not self.fastq_rv.endswith(".bz2")) \
+        and not self.fastq_fw.endswith(".bz2")) \
         or (not self.fastq_rv.endswith(".fastq") \
         and not self.fastq_rv.endswith(".fq") \
         and not self.fastq_rv.endswith(".gz") \
@@ -169,12 +388,6 @@ class Pipeline():
             self.logger.error(error)
             raise RuntimeError(error)
              
-        if not self.disable_barcode and not os.path.isfile(self.ids):
-            error = "Error parsing parameters.\n" \
-            "Invalid IDs file {}".format(self.ids)
-            self.logger.error(error)
-            raise RuntimeError(error)      
-        
         if not self.disable_barcode and self.ids is None:
             error = "Error IDs file is missing but the option to disable the " \
             "demultiplexing step is not activated\n"
@@ -199,42 +412,9 @@ class Pipeline():
                 "length as the UMIs {}.\n".format(self.umi_filter_template)
                 self.logger.error(error)
                 raise RuntimeError(error) 
-            # Convert the template into a reg-exp
-            temp_reg_exp = ""
-            for ele in self.umi_filter_template:
-                if ele == "W":
-                    temp_reg_exp += "[AT]"
-                elif ele == "S":
-                    temp_reg_exp += "[CG]"
-                elif ele == "N":
-                    temp_reg_exp += "[ATCG]"
-                elif ele == "V":
-                    temp_reg_exp += "[ACG]"
-                elif ele == "A":
-                    temp_reg_exp += "[A]"
-                elif ele == "C":
-                    temp_reg_exp += "[C]"
-                elif ele == "G":
-                    temp_reg_exp += "[G]"
-                elif ele == "T":
-                    temp_reg_exp += "[T]"
-                elif ele == "U":
-                    temp_reg_exp += "[U]"
-                elif ele == "R":
-                    temp_reg_exp += "[AG]"
-                elif ele == "Y":
-                    temp_reg_exp += "[CT]"
-                elif ele == "K":
-                    temp_reg_exp += "[GT]"
-                elif ele == "M":
-                    temp_reg_exp += "[AC]"
-                elif ele == "B":
-                    temp_reg_exp += "[CGT]"
-                elif ele == "D":
-                    temp_reg_exp += "[AGT]"
-                elif ele == "H":
-                    temp_reg_exp += "[ACT]"
-            self.umi_filter_template = temp_reg_exp
+            # Convert the template into a reg-exp (one table lookup per base)
+            self.umi_filter_template = "".join(IUPAC_TO_REGEX[ele] 
+                                               for ele in self.umi_filter_template)
                          
         # Add checks for trimming parameters, demultiplex parameters and UMI parameters
         if self.allowed_missed > self.allowed_kmer and not self.disable_barcode:
@@ -266,15 +446,59 @@ class Pipeline():
             self.logger.error(error)
             raise RuntimeError(error)              
                      
-        # Test the presence of the scripts 
-        required_scripts = set(['STAR'])
-        unavailable_scripts = set()
-        for script in required_scripts:
-            if which_program(script) is None: 
-                unavailable_scripts.add(script)
+        if self.star_genome_loading != "NoSharedMemory":
+            # STAR cannot use the 2-pass mode or sort the BAM within the 
+            # genome index size limit when the genome is in shared memory
+            # (STAR only sorts the BAM when the demultiplexing is disabled)
+            if self.two_pass_mode:
+                error = "Error starting the pipeline.\n" \
+                "The 2-pass mode cannot be used with a shared memory genome (--star-genome-loading)"
+                self.logger.error(error)
+                raise RuntimeError(error)
+            if self.star_sort_mem_limit <= 0 and self.disable_barcode:
+                error = "Error starting the pipeline.\n" \
+                "A BAM sort memory limit (--star-sort-mem-limit) must be given " \
+                "with a shared memory genome (--star-genome-loading)"
+                self.logger.error(error)
+                raise RuntimeError(error)
+        
+        if self.resume and self.temp_in_memory:
+            error = "Error starting the pipeline.\n" \
+            "A run cannot be resumed with the temporary files in memory (--temp-in-memory)"
+            self.logger.error(error)
+            raise RuntimeError(error)
+        
+        if self.star_release_genome and self.star_genome_loading != "LoadAndKeep":
+            self.logger.warning("The option to release the genome indexes is given " \
+                                "but the genome loading strategy is not LoadAndKeep.")
+            
+        if self.ref_annotation is not None and not os.path.isfile(self.ref_annotation):
+            error = "Error parsing parameters.\n" \
+            "Invalid annotation file {}".format(self.ref_annotation)
+            self.logger.error(error)
+            raise RuntimeError(error)
+        
+        if not os.path.isfile(self.fastq_fw) or not os.path.isfile(self.fastq_rv):
+            error = "Error parsing parameters.\n" \
+            "Invalid input files {} {}".format(self.fastq_fw, self.fastq_rv)
+            self.logger.error(error)
+            raise RuntimeError(error)
+                     
+        if not self.disable_barcode and not os.path.isfile(self.ids):
+            error = "Error parsing parameters.\n" \
+            "Invalid IDs file {}".format(self.ids)
+            self.logger.error(error)
+            raise RuntimeError(error)      
+        
+        # Test the presence of the scripts (samtools is used by STAR
+        # to read the input BAM and to sort/filter the BAM files)
+        required_scripts = set(['STAR', 'samtools'])
+        if not self.disable_barcode:
+            required_scripts.add('taggd_demultiplex.py')
+        unavailable_scripts = required_scripts - available_programs()
         if len(unavailable_scripts) != 0:
             error = "Error starting the pipeline.\n" \
-            "Required software not found:\t".join(unavailable_scripts)
+            "Required software not found:\t{}".format(" ".join(sorted(unavailable_scripts)))
             self.logger.error(error)
             raise RuntimeError(error)
             
@@ -295,6 +519,17 @@ class Pipeline():
                 else:
                     raise argparse.ArgumentTypeError("{0} is not a readable dir".format(prospective_dir))
 
+        def thread_count(value):
+            if value == "auto":
+                return value
+            try:
+                threads = int(value)
+            except ValueError:
+                threads = 0
+            if threads < 1:
+                raise argparse.ArgumentTypeError("{0} is not a valid number of threads".format(value))
+            return threads
+
         parser.add_argument('fastq_files', nargs=2)
         parser.add_argument('--ids', metavar="[FILE]", required=False,
                             help='Path to the file containing the map of barcodes to the array coordinates')
@@ -333,6 +568,9 @@ class Pipeline():
                             help="Start position of the IDs (Barcodes) in the R1 (counting from 0) (default: %(default)s)")
         parser.add_argument('--no-clean-up', action="store_false", default=True,
                             help="Do not remove temporary/intermediary files (useful for debugging)")
+        parser.add_argument('--resume', action="store_true", default=False,
+                            help="Skip the steps completed by a previous run with the same parameters\n" \
+                            "and temporary folder (--temp-folder). It implies --no-clean-up.")
         parser.add_argument('--verbose', action="store_true", default=False,
                             help="Show extra information on the log file")
         parser.add_argument('--mapping-threads', default=4, metavar="[INT]", type=int, choices=range(1, 33),
@@ -345,8 +583,14 @@ class Pipeline():
                             help="Name of the file that we want to use to store the logs (default output to screen)")
         parser.add_argument('--output-folder', metavar="[FOLDER]", action=readable_dir, default=None,
                             help='Path of the output folder')
-        parser.add_argument('--temp-folder', metavar="[FOLDER]", action=readable_dir, default=None,
-                            help='Path of the location for temporary files')
+        temp_group = parser.add_mutually_exclusive_group()
+        temp_group.add_argument('--temp-folder', metavar="[FOLDER]", action=readable_dir, default=None,
+                                help='Path of the location for temporary files')
+        temp_group.add_argument('--temp-in-memory', action="store_true", default=False,
+                                help="Write the temporary files in memory ({}) when there is enough space\n" \
+                                "for them (4 times the size of the decompressed input files). The temporary folder is\n" \
+                                "always removed at the end (the discarded files are moved to the output folder).\n" \
+                                "It cannot be used with --temp-folder or --resume.".format(MEMORY_FOLDER))
         parser.add_argument('--umi-allowed-mismatches', default=1, metavar="[INT]", type=int, choices=range(0, 9),
                             help="Number of allowed mismatches (hamming distance) " \
                             "that UMIs of the same gene-spot must have in order to cluster together (default: %(default)s)")
@@ -436,6 +680,13 @@ class Pipeline():
                             " into memory so it can easily be shared by other jobs so to save loading time.\n"
                             " Read the STAR manual for more info on this. (default: NoSharedMemory)",
                             choices=["NoSharedMemory","LoadAndKeep","LoadAndRemove", "LoadAndExit"])
+        parser.add_argument('--star-release-genome', default=False, action="store_true",
+                            help="Remove the genome indexes from the shared memory at the end of the run\n" \
+                            "when they were loaded with --star-genome-loading LoadAndKeep.")
+        parser.add_argument('--star-threads', default=None, metavar="[INT|auto]", type=thread_count,
+                            help="Number of threads to use in STAR. The value given in --mapping-threads\n" \
+                            "is used by default. Use auto to use one thread per physical core\n" \
+                            "as STAR does not scale with hyper-threading siblings.")
         parser.add_argument('--star-sort-mem-limit', default=0, type=int,
                             help="The maximum available RAM for sorting BAM during mapping. Default is 0\n" \
                             "which means that it will be set to the genome index size")
@@ -453,25 +704,21 @@ class Pipeline():
         Load the input parameters from the argparse object given as parameter
         :param options: a Argparse object
         """
-        self.allowed_missed = options.allowed_missed
-        self.allowed_kmer = options.allowed_kmer
-        self.overhang = options.overhang
-        self.min_length_trimming = options.min_length_qual_trimming
-        self.trimming_rv = options.mapping_rv_trimming
-        self.min_quality_trimming = options.min_quality_trimming
-        self.clean = options.no_clean_up
-        self.barcode_start = options.start_id
-        self.threads = options.mapping_threads
-        self.verbose = options.verbose
-        self.ids = os.path.abspath(options.ids)
+        # The options that are copied as they are
+        for attribute, option in INPUT_OPTIONS:
+            setattr(self, attribute, getattr(options, option))
+        # The intermediate files are needed to resume a run
+        self.clean = options.no_clean_up and not self.resume
+        if options.star_threads is None:
+            self.star_threads = self.threads
+        elif options.star_threads == "auto":
+            self.star_threads = getPhysicalCores()
+        else:
+            self.star_threads = options.star_threads
+        self.ids = os.path.abspath(options.ids) if options.ids is not None else None
         self.ref_map = os.path.abspath(options.ref_map)
         self.ref_annotation = os.path.abspath(options.ref_annotation) \
         if options.ref_annotation is not None else None
-        self.expName = options.expName
-        self.htseq_mode = options.htseq_mode
-        self.htseq_no_ambiguous = options.htseq_no_ambiguous
-        self.qual64 = options.qual_64
-        self.contaminant_index = options.contaminant_index
         # Load the given path into the system PATH
         if options.bin_path is not None and os.path.isdir(options.bin_path): 
             os.environ["PATH"] += os.pathsep + options.bin_path
@@ -483,50 +730,25 @@ class Pipeline():
             self.output_folder = os.path.abspath(options.output_folder)
         else:
             self.output_folder = os.path.abspath(os.getcwd())      
+        # The intermediate files take about 4 times the size of the (decompressed) input files
+        input_size = sum(os.path.getsize(f) * (COMPRESSED_FASTQ_RATIO if f.endswith((".gz", ".bz2")) else 1)
+                         for f in [self.fastq_fw, self.fastq_rv] if os.path.isfile(f))
         if options.temp_folder is not None and os.path.isdir(options.temp_folder): 
             self.temp_folder = os.path.abspath(options.temp_folder)
+        elif self.temp_in_memory and os.path.isdir(MEMORY_FOLDER) \
+        and getFreeSpace(MEMORY_FOLDER) >= 4 * input_size:
+            self.temp_folder = tempfile.mkdtemp(prefix="st_pipeline_temp", dir=MEMORY_FOLDER)
+            self._memory_temp_folder = True
         else:
             self.temp_folder = tempfile.mkdtemp(prefix="st_pipeline_temp")
-        self.umi_allowed_mismatches = options.umi_allowed_mismatches
-        self.umi_start_position = options.umi_start_position
-        self.umi_end_position = options.umi_end_position
-        self.keep_discarded_files = options.keep_discarded_files
-        self.remove_polyA_distance = options.remove_polyA
-        self.remove_polyT_distance = options.remove_polyT
-        self.remove_polyG_distance = options.remove_polyG
-        self.remove_polyC_distance = options.remove_polyC
-        self.remove_polyN_distance = options.remove_polyN
-        self.filter_AT_content = options.filter_AT_content
-        self.filter_GC_content = options.filter_GC_content
-        self.disable_multimap = options.disable_multimap
-        self.disable_clipping = options.disable_clipping
-        self.umi_cluster_algorithm = options.umi_cluster_algorithm
-        self.min_intron_size = options.min_intron_size
-        self.max_intron_size = options.max_intron_size
-        self.umi_filter = options.umi_filter
         self.umi_filter_template = options.umi_filter_template.upper()
-        self.compute_saturation = options.compute_saturation
-        self.include_non_annotated = options.include_non_annotated
-        self.inverse_trimming_rv = options.inverse_mapping_rv_trimming
-        self.two_pass_mode = options.two_pass_mode
-        self.strandness = options.strandness
-        self.umi_quality_bases = options.umi_quality_bases
-        self.umi_counting_offset = options.umi_counting_offset
-        self.taggd_metric = options.demultiplexing_metric
-        self.taggd_multiple_hits_keep_one = options.demultiplexing_multiple_hits_keep_one
-        self.taggd_trim_sequences = options.demultiplexing_trim_sequences
-        self.adaptor_missmatches = options.homopolymer_mismatches
-        self.star_genome_loading = options.star_genome_loading
-        self.star_sort_mem_limit = options.star_sort_mem_limit
-        self.disable_barcode = options.disable_barcode
-        self.disable_umi = options.disable_umi
-        self.transcriptome = options.transcriptome
         self.saturation_points = [int(p) for p in options.saturation_points] \
         if options.saturation_points is not None else None
         
         # Assign class parameters to the QA stats object
         attributes = inspect.getmembers(self, lambda a:not(inspect.isroutine(a)))
-        attributes_filtered = [a for a in attributes if not(a[0].startswith('__') and a[0].endswith('__'))]
+        # The private attributes are not input parameters
+        attributes_filtered = [a for a in attributes if not a[0].startswith('_')]
         # Assign general parameters to the qa_stats object
         qa_stats.input_parameters = attributes_filtered
         qa_stats.annotation_tool = "htseq-count {}".format(getHTSeqCountVersion())
@@ -547,77 +769,85 @@ class Pipeline():
         self.logger = logging.getLogger(self.__class__.LogName)
         self.logger.info("ST Pipeline {}".format(version_number))
         
-        # Some info
-        self.logger.info("Output directory: {}".format(self.output_folder))
-        self.logger.info("Temporary directory: {}".format(self.temp_folder))
-        self.logger.info("Dataset name: {}".format(self.expName))
-        self.logger.info("Forward(R1) input file: {}".format(self.fastq_fw))
-        self.logger.info("Reverse(R2) input file: {}".format(self.fastq_rv))
-        self.logger.info("Reference mapping STAR index folder: {}".format(self.ref_map))
+        # Some info (logged in one block)
+        parameters = []
+        parameters.append("Output directory: {}".format(self.output_folder))
+        parameters.append("Temporary directory: {}".format(self.temp_folder))
+        parameters.append("Dataset name: {}".format(self.expName))
+        parameters.append("Forward(R1) input file: {}".format(self.fastq_fw))
+        parameters.append("Reverse(R2) input file: {}".format(self.fastq_rv))
+        parameters.append("Reference mapping STAR index folder: {}".format(self.ref_map))
         if self.ref_annotation is not None:
-            self.logger.info("Reference annotation file: {}".format(self.ref_annotation))
+            parameters.append("Reference annotation file: {}".format(self.ref_annotation))
         if self.contaminant_index is not None:
-            self.logger.info("Using contamination filter STAR index: {}".format(self.contaminant_index))
-        self.logger.info("CPU Nodes: {}".format(self.threads))
+            parameters.append("Using contamination filter STAR index: {}".format(self.contaminant_index))
+        parameters.append("CPU Nodes: {}".format(self.threads))
+        parameters.append("STAR threads: {}".format(self.star_threads))
         if not self.disable_barcode:
-            self.logger.info("Ids(barcodes) file: {}".format(self.ids))
-            self.logger.info("TaggD allowed mismatches: {}".format(self.allowed_missed))
-            self.logger.info("TaggD kmer size: {}".format(self.allowed_kmer))
-            self.logger.info("TaggD overhang: {}".format(self.overhang))
-            self.logger.info("TaggD metric: {}".format(self.taggd_metric))
+            parameters.append("Ids(barcodes) file: {}".format(self.ids))
+            parameters.append("TaggD allowed mismatches: {}".format(self.allowed_missed))
+            parameters.append("TaggD kmer size: {}".format(self.allowed_kmer))
+            parameters.append("TaggD overhang: {}".format(self.overhang))
+            parameters.append("TaggD metric: {}".format(self.taggd_metric))
             if self.taggd_multiple_hits_keep_one:
-                self.logger.info("TaggD multiple hits keep one (random) is enabled")
+                parameters.append("TaggD multiple hits keep one (random) is enabled")
             if self.taggd_trim_sequences is not None:
-                self.logger.info("TaggD trimming from the barcodes " + '-'.join(str(x) for x in self.taggd_trim_sequences))
+                parameters.append("TaggD trimming from the barcodes " + '-'.join(str(x) for x in self.taggd_trim_sequences))
         else:
-            self.logger.info("TaggD demultiplexing is disabled!")
-        self.logger.info("Mapping reverse trimming: {}".format(self.trimming_rv))
-        self.logger.info("Mapping inverse reverse trimming: {}".format(self.inverse_trimming_rv))
-        self.logger.info("Mapping tool: STAR")
-        self.logger.info("Annotation tool: HTSeq")
-        self.logger.info("Annotation mode: {}".format(self.htseq_mode))
-        self.logger.info("Annotation strandness {}".format(self.strandness))
-        self.logger.info("Remove reads whose AT content is {}%".format(self.filter_AT_content))
-        self.logger.info("Remove reads whose GC content is {}%".format(self.filter_GC_content))
+            parameters.append("TaggD demultiplexing is disabled!")
+        parameters.append("Mapping reverse trimming: {}".format(self.trimming_rv))
+        parameters.append("Mapping inverse reverse trimming: {}".format(self.inverse_trimming_rv))
+        parameters.append("Mapping tool: STAR")
+        parameters.append("Annotation tool: HTSeq")
+        parameters.append("Annotation mode: {}".format(self.htseq_mode))
+        parameters.append("Annotation strandness {}".format(self.strandness))
+        parameters.append("Remove reads whose AT content is {}%".format(self.filter_AT_content))
+        parameters.append("Remove reads whose GC content is {}%".format(self.filter_GC_content))
         if self.disable_clipping:
-            self.logger.info("Not allowing soft clipping when mapping with STAR")
+            parameters.append("Not allowing soft clipping when mapping with STAR")
         if self.disable_multimap:
-            self.logger.info("Not allowing multiple alignments when mapping with STAR")
-        self.logger.info("Mapping minimum intron size allowed (splice alignments) with STAR: {}".format(self.min_intron_size))
-        self.logger.info("Mapping maximum intron size allowed (splice alignments) with STAR: {}".format(self.max_intron_size))
-        self.logger.info("STAR genome loading strategy {}".format(self.star_genome_loading))
+            parameters.append("Not allowing multiple alignments when mapping with STAR")
+        parameters.append("Mapping minimum intron size allowed (splice alignments) with STAR: {}".format(self.min_intron_size))
+        parameters.append("Mapping maximum intron size allowed (splice alignments) with STAR: {}".format(self.max_intron_size))
+        parameters.append("STAR genome loading strategy {}".format(self.star_genome_loading))
+        if self.star_genome_loading != "NoSharedMemory" and self.ref_annotation is not None:
+            parameters.append("STAR will use the splice junctions present in the genome index")
         if self.compute_saturation:
-            self.logger.info("Computing saturation curve with several sub-samples...")
+            parameters.append("Computing saturation curve with several sub-samples...")
             if self.saturation_points is not None:
-                self.logger.info("Using the following points {}".format(' '.join(str(p) for p in self.saturation_points)))
+                parameters.append("Using the following points {}".format(' '.join(str(p) for p in self.saturation_points)))
         if self.include_non_annotated:
-            self.logger.info("Including non annotated reads in the output")
+            parameters.append("Including non annotated reads in the output")
         if not self.disable_umi:
-            self.logger.info("UMIs start position: {}".format(self.umi_start_position))
-            self.logger.info("UMIs end position: {}".format(self.umi_end_position))
-            self.logger.info("UMIs allowed mismatches: {}".format(self.umi_allowed_mismatches))
-            self.logger.info("UMIs clustering algorithm: {}".format(self.umi_cluster_algorithm))
-            self.logger.info("Allowing an offset of {} when clustering UMIs " \
-                             "by strand-start in a gene-spot".format(self.umi_counting_offset))
-            self.logger.info("Allowing {} low quality bases in an UMI".format(self.umi_quality_bases))
-            self.logger.info("Discarding reads that after trimming are shorter than {}".format(self.min_length_trimming))
+            parameters.append("UMIs start position: {}".format(self.umi_start_position))
+            parameters.append("UMIs end position: {}".format(self.umi_end_position))
+            parameters.append("UMIs allowed mismatches: {}".format(self.umi_allowed_mismatches))
+            parameters.append("UMIs clustering algorithm: {}".format(self.umi_cluster_algorithm))
+            parameters.append("Allowing an offset of {} when clustering UMIs " \
+                              "by strand-start in a gene-spot".format(self.umi_counting_offset))
+            parameters.append("Allowing {} low quality bases in an UMI".format(self.umi_quality_bases))
+            parameters.append("Discarding reads that after trimming are shorter than {}".format(self.min_length_trimming))
             if self.umi_filter:
-                self.logger.info("UMIs using filter: {}".format(self.umi_filter_template))
+                parameters.append("UMIs using filter: {}".format(self.umi_filter_template))
         else:
-            self.logger.info("UMIs filtering is disabled!")
+            parameters.append("UMIs filtering is disabled!")
         if self.remove_polyA_distance > 0:
-            self.logger.info("Removing polyA sequences of a length of at least: {}".format(self.remove_polyA_distance))                        
+            parameters.append("Removing polyA sequences of a length of at least: {}".format(self.remove_polyA_distance))                        
         if self.remove_polyT_distance > 0:
-            self.logger.info("Removing polyT sequences of a length of at least: {}".format(self.remove_polyT_distance))
+            parameters.append("Removing polyT sequences of a length of at least: {}".format(self.remove_polyT_distance))
         if self.remove_polyG_distance > 0:
-            self.logger.info("Removing polyG sequences of a length of at least: {}".format(self.remove_polyG_distance))
+            parameters.append("Removing polyG sequences of a length of at least: {}".format(self.remove_polyG_distance))
         if self.remove_polyC_distance > 0:
-            self.logger.info("Removing polyC sequences of a length of at least: {}".format(self.remove_polyC_distance))
+            parameters.append("Removing polyC sequences of a length of at least: {}".format(self.remove_polyC_distance))
         if self.remove_polyN_distance > 0:
-            self.logger.info("Removing polyN sequences of a length of at least: {}".format(self.remove_polyN_distance))
-        self.logger.info("Allowing {} mismatches when removing homopolymers".format(self.adaptor_missmatches))
+            parameters.append("Removing polyN sequences of a length of at least: {}".format(self.remove_polyN_distance))
+        parameters.append("Allowing {} mismatches when removing homopolymers".format(self.adaptor_missmatches))
         if self.two_pass_mode :
-            self.logger.info("Using the STAR 2-pass mode for the mapping step")
+            parameters.append("Using the STAR 2-pass mode for the mapping step")
+        self.logger.info("\n".join(parameters))
+        if self.temp_in_memory and not self._memory_temp_folder:
+            self.logger.warning("There is not enough space in {} for the temporary files, " \
+                                "using {} instead".format(MEMORY_FOLDER, self.temp_folder))
         
     def run(self):
         """ 
@@ -642,98 +872,123 @@ class Pipeline():
         start_exe_time = globaltime.getTimestamp()
         self.logger.info("Starting the pipeline: {}".format(start_exe_time))
 
-        # Check if input fastq files are compressed
-        # TODO reliable way to test if files are compressed (something more robust than just file name endings)
-        try:
-            temp_r1_fifo_name = os.path.join(self.temp_folder, "R1_TMP_FIFO.fq")
-            temp_r2_fifo_name = os.path.join(self.temp_folder, "R2_TMP_FIFO.fq")
-            
-            if self.fastq_fw.endswith(".gz"):
-                r1_decompression_command = "gzip --decompress --stdout {} > {}".format(
-                                                                                       self.fastq_fw.replace(' ','\ '),
-                                                                                       temp_r1_fifo_name)
-            elif self.fastq_fw.endswith(".bz2"):
-                r1_decompression_command = "bzip2 --decompress --stdout {} > {}".format(
-                                                                                        self.fastq_fw.replace(' ','\ '),
-                                                                                        temp_r1_fifo_name)
-            else:
-                r1_decompression_command = None
-                
-            if self.fastq_rv.endswith(".gz"):
-                r2_decompression_command = "gzip --decompress --stdout {} > {}".format(
-                                                                                       self.fastq_rv.replace(' ','\ '),
-                                                                                       temp_r2_fifo_name)
-            elif self.fastq_rv.endswith(".bz2"):
-                r2_decompression_command = "bzip2 --decompress --stdout {} > {}".format(
-                                                                                        self.fastq_rv.replace(' ','\ '),
-                                                                                        temp_r2_fifo_name)
-            else:
-                r2_decompression_command = None
-
-            if r1_decompression_command:
-                os.mkfifo(temp_r1_fifo_name)
-                subprocess.Popen(r1_decompression_command, shell=True, preexec_fn=os.setsid)
-                self.fastq_fw = temp_r1_fifo_name
-            
-            if r2_decompression_command:
-                os.mkfifo(temp_r2_fifo_name)
-                subprocess.Popen(r2_decompression_command, shell=True, preexec_fn=os.setsid)
-                self.fastq_rv = temp_r2_fifo_name
-
-        except Exception as e:
-            self.logger.error("Error while starting the decompression of "
-            "GZIP/BZIP2 input files {0} {1}".format(self.fastq_fw, self.fastq_rv))
-            raise e
+        # The steps completed by a previous run are skipped when resuming
+        checkpoint_steps = self.checkpoint_steps()
+        skipped_steps = self.load_checkpoints(checkpoint_steps)
 
         #=================================================================
         # STEP: FILTERING 
         # Applies different filters : sanity, quality, short, adaptors, UMI...
         #=================================================================
+        if "filtering" not in skipped_steps:
+            # Check if input fastq files are compressed
+            # TODO reliable way to test if files are compressed (something more robust than just file name endings)
+            decompression_procs = []
+            try:
+                temp_r1_fifo_name = os.path.join(self.temp_folder, "R1_TMP_FIFO.fq")
+                temp_r2_fifo_name = os.path.join(self.temp_folder, "R2_TMP_FIFO.fq")
+
+                # The multi-threaded versions of gzip/bzip2 are used if they are available
+                gzip_program = "pigz" if "pigz" in available_programs() else "gzip"
+                bzip2_program = "pbzip2" if "pbzip2" in available_programs() else "bzip2"
+            
+                if self.fastq_fw.endswith(".gz"):
+                    r1_decompression_command = "{} --decompress --stdout {} > {}".format(gzip_program,
+                                                                                           self.fastq_fw.replace(' ','\ '),
+                                                                                           temp_r1_fifo_name)
+                elif self.fastq_fw.endswith(".bz2"):
+                    r1_decompression_command = "{} --decompress --stdout {} > {}".format(bzip2_program,
+                                                                                            self.fastq_fw.replace(' ','\ '),
+                                                                                            temp_r1_fifo_name)
+                else:
+                    r1_decompression_command = None
+                
+                if self.fastq_rv.endswith(".gz"):
+                    r2_decompression_command = "{} --decompress --stdout {} > {}".format(gzip_program,
+                                                                                           self.fastq_rv.replace(' ','\ '),
+                                                                                           temp_r2_fifo_name)
+                elif self.fastq_rv.endswith(".bz2"):
+                    r2_decompression_command = "{} --decompress --stdout {} > {}".format(bzip2_program,
+                                                                                            self.fastq_rv.replace(' ','\ '),
+                                                                                            temp_r2_fifo_name)
+                else:
+                    r2_decompression_command = None
+
+                if r1_decompression_command:
+                    os.mkfifo(temp_r1_fifo_name)
+                    decompression_procs.append((r1_decompression_command,
+                                                subprocess.Popen(r1_decompression_command, 
+                                                                 shell=True, start_new_session=True)))
+                    self.fastq_fw = temp_r1_fifo_name
+            
+                if r2_decompression_command:
+                    os.mkfifo(temp_r2_fifo_name)
+                    decompression_procs.append((r2_decompression_command,
+                                                subprocess.Popen(r2_decompression_command, 
+                                                                 shell=True, start_new_session=True)))
+                    self.fastq_rv = temp_r2_fifo_name
 
-        # Get the barcode length
-        barcode_length = len(list(read_barcode_file(self.ids).values())[0].sequence)
+            except Exception as e:
+                self.logger.error("Error while starting the decompression of "
+                "GZIP/BZIP2 input files {0} {1}".format(self.fastq_fw, self.fastq_rv))
+                raise e
+
+            # Get the barcode length
+            barcode_length = len(list(read_barcode_file(self.ids).values())[0].sequence)
     
-        # Start the filterInputReads function
-        self.logger.info("Start filtering raw reads {}".format(globaltime.getTimestamp()))
-        try:
-            InputReadsFilter(self.fastq_fw,
-                             self.fastq_rv,
-                             FILENAMES["quality_trimmed_R2"],
-                             FILENAMES_DISCARDED["quality_trimmed_discarded"] if self.keep_discarded_files else None,
-                             barcode_length,
-                             self.barcode_start,
-                             self.filter_AT_content,
-                             self.filter_GC_content,
-                             self.umi_start_position,
-                             self.umi_end_position,
-                             self.min_quality_trimming,
-                             self.min_length_trimming,
-                             self.remove_polyA_distance,
-                             self.remove_polyT_distance,
-                             self.remove_polyG_distance,
-                             self.remove_polyC_distance,
-                             self.remove_polyN_distance,
-                             self.qual64,
-                             self.umi_filter,
-                             self.umi_filter_template,
-                             self.umi_quality_bases,
-                             self.adaptor_missmatches,
-                             self.overhang,
-                             self.disable_umi,
-                             self.disable_barcode)
-        except Exception:
-            raise
+            # Start the filterInputReads function
+            self.logger.info("Start filtering raw reads {}".format(globaltime.getTimestamp()))
+            try:
+                InputReadsFilter(self.fastq_fw,
+                                 self.fastq_rv,
+                                 FILENAMES["quality_trimmed_R2"],
+                                 FILENAMES_DISCARDED["quality_trimmed_discarded"] if self.keep_discarded_files else None,
+                                 barcode_length,
+                                 self.barcode_start,
+                                 self.filter_AT_content,
+                                 self.filter_GC_content,
+                                 self.umi_start_position,
+                                 self.umi_end_position,
+                                 self.min_quality_trimming,
+                                 self.min_length_trimming,
+                                 self.remove_polyA_distance,
+                                 self.remove_polyT_distance,
+                                 self.remove_polyG_distance,
+                                 self.remove_polyC_distance,
+                                 self.remove_polyN_distance,
+                                 self.qual64,
+                                 self.umi_filter,
+                                 self.umi_filter_template,
+                                 self.umi_quality_bases,
+                                 self.adaptor_missmatches,
+                                 self.overhang,
+                                 self.disable_umi,
+                                 self.disable_barcode,
+                                 self.threads)
+            except Exception:
+                raise
         
-        # After filtering is completed remove the temporary FIFOs
-        if is_fifo(temp_r1_fifo_name): 
-            os.remove(temp_r1_fifo_name)
-        if is_fifo(temp_r2_fifo_name): 
-            os.remove(temp_r2_fifo_name)
+            # After filtering is completed remove the temporary FIFOs
+            if is_fifo(temp_r1_fifo_name): 
+                os.remove(temp_r1_fifo_name)
+            if is_fifo(temp_r2_fifo_name): 
+                os.remove(temp_r2_fifo_name)
+                
+            # A corrupted input file would give truncated reads so the
+            # exit code of the decompression is checked (their messages go to stderr).
+            # The shell exits with 141 (SIGPIPE) if the reads were not all read.
+            for command, proc in decompression_procs:
+                if proc.wait() not in (0, 128 + signal.SIGPIPE):
+                    error = "Error decompressing the GZIP/BZIP2 input files.\n" \
+                    "The command {} returned the error code {}".format(command, proc.returncode)
+                    self.logger.error(error)
+                    raise RuntimeError(error)
+            self.save_checkpoint("filtering", checkpoint_steps)
         
         #=================================================================
         # CONDITIONAL STEP: Filter out contaminated reads, e.g. typically bacterial rRNA
         #=================================================================
-        if self.contaminant_index:
+        if self.contaminant_index and "contaminant_filter" not in skipped_steps:
             # To remove contaminants sequence we align the reads to the contaminant genome
             # and keep the un-mapped reads
             self.logger.info("Starting contaminant filter alignment {}".format(globaltime.getTimestamp()))
@@ -746,7 +1001,7 @@ class Pipeline():
                            self.temp_folder,
                            self.trimming_rv,
                            self.inverse_trimming_rv,
-                           self.threads,
+                           self.star_threads,
                            1, # Disable splice alignments in contaminant filter
                            1, # Disable splice alignments in contaminant filter
                            False, # Disable multimap in contaminant filter
@@ -755,16 +1010,22 @@ class Pipeline():
                            self.min_length_trimming,
                            True, # Include un-aligned reads in the output     
                            self.star_genome_loading,
-                           self.star_sort_mem_limit) 
+                           self.star_sort_mem_limit,
+                           False) # The un-aligned reads are extracted in any order
                 # Extract the contaminant free reads (not aligned) from the output of STAR
                 # NOTE: this will not be needed when STAR allows to chose the discarded
                 # reads format (BAM)
                 # We also need to set the NH tag to Null so to be able to run STAR again
+                # The contaminated reads (mapped) are only written if the discarded files are kept
                 infile = pysam.AlignmentFile(FILENAMES_DISCARDED["contaminated_discarded"], "rb")
                 out_unmap = pysam.AlignmentFile(FILENAMES["contaminated_clean"], "wb", template=infile)
-                temp_name = os.path.join(self.temp_folder, next(tempfile._get_candidate_names()))
-                out_map = pysam.AlignmentFile(temp_name, "wb", template=infile)
+                out_map = None
+                if self.keep_discarded_files:
+                    temp_name = os.path.join(self.temp_folder, next(tempfile._get_candidate_names()))
+                    out_map = pysam.AlignmentFile(temp_name, "wb", template=infile)
                 for sam_record in infile.fetch(until_eof=True):
+                    if out_map is None and not sam_record.is_unmapped:
+                        continue
                     try:
                         sam_record.set_tag("NH", None)
                         sam_record.set_tag("HI", None)
@@ -780,55 +1041,73 @@ class Pipeline():
                     else:
                         out_map.write(sam_record)
                 infile.close()
-                out_map.close()
                 out_unmap.close()
-                shutil.move(temp_name, FILENAMES_DISCARDED["contaminated_discarded"])
+                if out_map is not None:
+                    out_map.close()
+                    shutil.move(temp_name, FILENAMES_DISCARDED["contaminated_discarded"])
+                else:
+                    self._cleanup_pool.submit(safeRemove, FILENAMES_DISCARDED["contaminated_discarded"])
+                self.remove_intermediate(FILENAMES["quality_trimmed_R2"])
             except Exception:
                 raise
+            self.save_checkpoint("contaminant_filter", checkpoint_steps)
              
         #=================================================================
         # STEP: Maps against the genome using STAR
         #=================================================================
-        self.logger.info("Starting genome alignment {}".format(globaltime.getTimestamp()))
-        input_reads = FILENAMES["contaminated_clean"] if self.contaminant_index else FILENAMES["quality_trimmed_R2"]
-        try:
-            # Make the alignment call
-            alignReads(input_reads,
-                       self.ref_map,
-                       FILENAMES["mapped"],
-                       self.ref_annotation,
-                       self.temp_folder,
-                       self.trimming_rv,
-                       self.inverse_trimming_rv,
-                       self.threads,
-                       self.min_intron_size,
-                       self.max_intron_size,
-                       self.disable_multimap,
-                       self.disable_clipping,
-                       self.two_pass_mode,
-                       self.min_length_trimming,
-                       self.keep_discarded_files,
-                       self.star_genome_loading,
-                       self.star_sort_mem_limit)        
-            # Remove secondary alignments and un-mapped
-            # NOTE: this will not be needed when STAR allows to chose the discarded
-            # reads format (BAM)
-            if self.keep_discarded_files:
-                temp_name = os.path.join(self.temp_folder, next(tempfile._get_candidate_names()))
-                # Note use 260 to also discard multiple-alignments
-                command = "samtools view -b -h -F 4 -@ {} -o {} -U {} {}".format(self.threads,
-                                                                                 temp_name,
-                                                                                 FILENAMES_DISCARDED["mapped_discarded"],
-                                                                                 FILENAMES["mapped"])
-                subprocess.check_call(command, shell=True)
-                os.rename(temp_name, FILENAMES["mapped"])                
-        except Exception:
-            raise
+        # The annotation file is parsed in the background while the reads
+        # are mapped and demultiplexed (STAR and Taggd run in other processes)
+        if not self.transcriptome and "annotation" not in skipped_steps:
+            annotation_features = BackgroundTask(load_features,
+                                                 self.ref_annotation,
+                                                 self.strandness,
+                                                 "exon",
+                                                 "gene_id")
+        if "mapping" not in skipped_steps:
+            self.logger.info("Starting genome alignment {}".format(globaltime.getTimestamp()))
+            input_reads = FILENAMES["contaminated_clean"] if self.contaminant_index else FILENAMES["quality_trimmed_R2"]
+            try:
+                # Make the alignment call
+                alignReads(input_reads,
+                           self.ref_map,
+                           FILENAMES["mapped"],
+                           self.ref_annotation,
+                           self.temp_folder,
+                           self.trimming_rv,
+                           self.inverse_trimming_rv,
+                           self.star_threads,
+                           self.min_intron_size,
+                           self.max_intron_size,
+                           self.disable_multimap,
+                           self.disable_clipping,
+                           self.two_pass_mode,
+                           self.min_length_trimming,
+                           self.keep_discarded_files,
+                           self.star_genome_loading,
+                           self.star_sort_mem_limit,
+                           # The demultiplexed reads are sorted after the demultiplexing
+                           self.disable_barcode) 
+                # Remove secondary alignments and un-mapped
+                # NOTE: this will not be needed when STAR allows to chose the discarded
+                # reads format (BAM)
+                if self.keep_discarded_files:
+                    temp_name = os.path.join(self.temp_folder, next(tempfile._get_candidate_names()))
+                    # Note use 260 to also discard multiple-alignments
+                    command = "samtools view -b -h -F 4 -@ {} -o {} -U {} {}".format(self.threads,
+                                                                                     temp_name,
+                                                                                     FILENAMES_DISCARDED["mapped_discarded"],
+                                                                                     FILENAMES["mapped"])
+                    subprocess.check_call(command, shell=True)
+                    os.rename(temp_name, FILENAMES["mapped"])
+                self.remove_intermediate(input_reads)
+            except Exception:
+                raise
+            self.save_checkpoint("mapping", checkpoint_steps)
                       
         #=================================================================
         # STEP: DEMULTIPLEX READS Map against the barcodes
         #=================================================================
-        if not self.disable_barcode:
+        if not self.disable_barcode and "demultiplexing" not in skipped_steps:
             self.logger.info("Starting barcode demultiplexing {}".format(globaltime.getTimestamp()))
             try:
                 barcodeDemultiplexing(FILENAMES["mapped"],
@@ -844,46 +1123,53 @@ class Pipeline():
                                       FILENAMES["demultiplexed_prefix"], # Prefix for output files
                                       self.keep_discarded_files)
                 # TaggD does not output the BAM file sorted
-                command = "samtools sort -T {}/sort_bam -@ {} -o {} {}".format(self.temp_folder,
-                                                                            self.threads,
-                                                                            FILENAMES["demultiplexed_matched"],
-                                                                            FILENAMES["demultiplexed_matched"])
+                # (fastest compression as the sorted BAM is only read by the annotation)
+                command = "samtools sort -l 1 -T {}/sort_bam -@ {} -o {} {}".format(self.temp_folder,
+                                                                                 self.threads,
+                                                                                 FILENAMES["demultiplexed_matched"],
+                                                                                 FILENAMES["demultiplexed_matched"])
                 subprocess.check_call(command, shell=True)
+                self.remove_intermediate(FILENAMES["mapped"])
             except Exception:
                 raise 
+            self.save_checkpoint("demultiplexing", checkpoint_steps)
         
         #=================================================================
         # STEP: annotate using htseq-count
         #=================================================================
-        if self.transcriptome:
-            self.logger.info("Assigning gene names from transcriptome {}".format(globaltime.getTimestamp()))
-            # Iterate the BAM file to set the gene name as the transcriptome's entry
+        if "annotation" not in skipped_steps:
             input_file = FILENAMES["demultiplexed_matched"] if not self.disable_barcode else FILENAMES["mapped"]
-            flag_read = "rb"
-            flag_write = "wb"
-            infile = pysam.AlignmentFile(input_file, flag_read)
-            outfile = pysam.AlignmentFile(FILENAMES["annotated"], flag_write, template=infile)
-            for rec in infile.fetch(until_eof=True):
-                #NOTE chrom may have to be trimmed to 250 characters max
-                chrom = infile.getrname(rec.reference_id).split()[0]
-                rec.set_tag("XF", chrom, "Z")
-                outfile.write(rec)
-            infile.close()
-            outfile.close()
-        else:
-            self.logger.info("Starting annotation {}".format(globaltime.getTimestamp()))
-            try:
-                annotateReads(FILENAMES["demultiplexed_matched"] if not self.disable_barcode else FILENAMES["mapped"],
-                              self.ref_annotation, 
-                              FILENAMES["annotated"], 
-                              FILENAMES_DISCARDED["annotated_discarded"] if self.keep_discarded_files else None,
-                              self.htseq_mode, self.strandness, 
-                              self.htseq_no_ambiguous, 
-                              self.include_non_annotated, 
-                              self.temp_folder, 
-                              self.threads)
-            except Exception:
-                raise
+            if self.transcriptome:
+                self.logger.info("Assigning gene names from transcriptome {}".format(globaltime.getTimestamp()))
+                # Iterate the BAM file to set the gene name as the transcriptome's entry
+                flag_read = "rb"
+                flag_write = "wb"
+                infile = pysam.AlignmentFile(input_file, flag_read)
+                outfile = pysam.AlignmentFile(FILENAMES["annotated"], flag_write, template=infile)
+                for rec in infile.fetch(until_eof=True):
+                    #NOTE chrom may have to be trimmed to 250 characters max
+                    chrom = infile.getrname(rec.reference_id).split()[0]
+                    rec.set_tag("XF", chrom, "Z")
+                    outfile.write(rec)
+                infile.close()
+                outfile.close()
+            else:
+                self.logger.info("Starting annotation {}".format(globaltime.getTimestamp()))
+                try:
+                    annotateReads(input_file,
+                                  self.ref_annotation, 
+                                  FILENAMES["annotated"], 
+                                  FILENAMES_DISCARDED["annotated_discarded"] if self.keep_discarded_files else None,
+                                  self.htseq_mode, self.strandness, 
+                                  self.htseq_no_ambiguous, 
+                                  self.include_non_annotated, 
+                                  self.temp_folder, 
+                                  self.threads,
+                                  annotation_features)
+                except Exception:
+                    raise
+            self.remove_intermediate(input_file)
+            self.save_checkpoint("annotation", checkpoint_steps)
 
         #=================================================================
         # STEP: compute saturation (Optional)
@@ -929,9 +1215,9 @@ class Pipeline():
         # END PIPELINE
         #=================================================================
         # Write stats to JSON
-        print(qa_stats)
-        # TODO this is giving problems in Python3
-        #qa_stats.writeJSON(os.path.join(self.output_folder, self.expName + "_qa_stats.json"))
+        qa_stats_file = os.path.join(self.output_folder, self.expName + "_qa_stats.json")
+        qa_stats.writeJSON(qa_stats_file)
+        self.logger.info("QA stats written to {}:\n{}".format(qa_stats_file, qa_stats.toJSON()))
         
         finish_exe_time = globaltime.getTimestamp()
         total_exe_time = finish_exe_time - start_exe_time
@@ -4,7 +4,7 @@ Unit-test the package adaptors
 """
 
 import unittest
-from stpipeline.common.adaptors import removeAdaptor
+from stpipeline.common.adaptors import removeAdaptor, findAdaptor, findAdaptors
 
 class TestAdaptors(unittest.TestCase):
        
@@ -36,7 +36,41 @@ class TestAdaptors(unittest.TestCase):
         result_seq, result_qual = removeAdaptor(seq_adaptor_end, fake_qual, adaptor, missmatches=0)
         self.assertTrue(len(result_seq) == 15 and len(result_qual) == 15)
 
+        # Bytes records are also supported
+        result_seq, result_qual = removeAdaptor(seq_adaptor_middle.encode(), fake_qual.encode(), 
+                                                adaptor.encode(), missmatches=0)
+        self.assertTrue(result_seq == b"AAAAAAAAAA" and result_qual == b"AAAAAAAAAA")
+        result_seq, result_qual = removeAdaptor(b"AAAAAAAAAATTATTAAAAA", fake_qual.encode(), 
+                                                adaptor.encode(), missmatches=1)
+        self.assertTrue(result_seq == b"AAAAAAAAAA" and result_qual == b"AAAAAAAAAA")
+
         #TODO add tests with missmatches
+
+    def test_findAdaptor(self):
+        """
+        Test that the function findAdaptor only searches
+        the adaptor before the given end position
+        """
+        sequence = b"AAAAAAAAAATTTTTAAAAA"
+        adaptor = b"TTTTT"
+        self.assertEqual(findAdaptor(sequence, adaptor, 0), 10)
+        self.assertEqual(findAdaptor(sequence, adaptor, 0, 15), 10)
+        self.assertEqual(findAdaptor(sequence, adaptor, 0, 14), -1)
+        self.assertEqual(findAdaptor(b"AAAAAAAAAATTATTAAAAA", adaptor, 1, 15), 10)
+        self.assertEqual(findAdaptor(b"AAAAAAAAAATTATTAAAAA", adaptor, 1, 12), -1)
+
+    def test_findAdaptors(self):
+        """
+        Test that the function findAdaptors removes the adaptors
+        in order and stops when the read is too short
+        """
+        sequence = b"CCCCCCCCCCTTTTTGGGGGAAAAACCCCC"
+        adaptors = [b"AAAAA", b"TTTTT"]
+        self.assertEqual(findAdaptors(sequence, adaptors, 0), 10)
+        self.assertEqual(findAdaptors(sequence, adaptors, 0, min_length=20), 20)
+        self.assertEqual(findAdaptors(sequence, adaptors, 0, 18), 10)
+        self.assertEqual(findAdaptors(sequence, [b"GGGGG"], 0, 18), 18)
+        self.assertEqual(findAdaptors(b"CCCCCCCCCCTTATTGGGGGAAGAACCCCC", adaptors, 1), 10)
         
 if __name__ == '__main__':
     unittest.main()    
\ No newline at end of file
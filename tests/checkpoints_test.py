@@ -0,0 +1,106 @@
+#! /usr/bin/env python
+"""
+Unit-test the checkpoints used to resume a run of the pipeline
+"""
+
+import unittest
+import tempfile
+import logging
+import shutil
+import os
+from stpipeline.core.pipeline import Pipeline, FILENAMES, FILENAMES_DISCARDED
+from stpipeline.common.stats import qa_stats
+
+class TestCheckpoints(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="st_pipeline_test_checkpoints")
+        # Pipeline.run() changes the global file names in place so they 
+        # are saved and the intermediate files are placed in the test folder
+        self.filenames = dict(FILENAMES)
+        self.filenames_discarded = dict(FILENAMES_DISCARDED)
+        for key, value in list(FILENAMES.items()):
+            FILENAMES[key] = os.path.join(self.tmpdir, os.path.basename(value))
+        self.pipeline = self.create_pipeline()
+        self.steps = self.pipeline.checkpoint_steps()
+        # Write the outputs and the checkpoints of all the steps
+        for step, _, outputs in self.steps:
+            for output in outputs:
+                with open(output, "w") as filehandler:
+                    filehandler.write(step)
+            self.pipeline.save_checkpoint(step, self.steps)
+
+    def tearDown(self):
+        FILENAMES.clear()
+        FILENAMES.update(self.filenames)
+        FILENAMES_DISCARDED.clear()
+        FILENAMES_DISCARDED.update(self.filenames_discarded)
+        shutil.rmtree(self.tmpdir)
+
+    def create_pipeline(self):
+        pipeline = Pipeline()
+        pipeline.resume = True
+        pipeline.temp_folder = self.tmpdir
+        pipeline.fastq_fw = os.path.join(self.tmpdir, "R1.fastq")
+        pipeline.fastq_rv = os.path.join(self.tmpdir, "R2.fastq")
+        pipeline.ids = os.path.join(self.tmpdir, "ids.txt")
+        pipeline.ref_map = self.tmpdir
+        pipeline.logger = logging.getLogger(Pipeline.LogName)
+        return pipeline
+
+    def checkpoints(self):
+        return sorted(f for f in os.listdir(self.tmpdir) if f.endswith(".done"))
+
+    def test_resume_all_steps(self):
+        """
+        Test that all the steps are skipped when the parameters
+        and the outputs have not changed and that the QA stats are restored
+        """
+        qa_stats.input_reads_forward = 10
+        self.pipeline.save_checkpoint("annotation", self.steps)
+        qa_stats.input_reads_forward = 0
+        pipeline = self.create_pipeline()
+        skipped = pipeline.load_checkpoints(pipeline.checkpoint_steps())
+        self.assertEqual(skipped, set(["filtering", "mapping", "demultiplexing", "annotation"]))
+        self.assertEqual(qa_stats.input_reads_forward, 10)
+
+    def test_digest_change(self):
+        """
+        Test that a change in the parameters of a step
+        invalidates the checkpoints of that step and the next ones
+        """
+        pipeline = self.create_pipeline()
+        pipeline.max_intron_size = 1000
+        skipped = pipeline.load_checkpoints(pipeline.checkpoint_steps())
+        self.assertEqual(skipped, set(["filtering"]))
+        self.assertEqual(self.checkpoints(), ["filtering.done"])
+
+    def test_missing_output(self):
+        """
+        Test that a step is not skipped when its output is missing
+        """
+        os.remove(FILENAMES["demultiplexed_matched"])
+        os.remove(FILENAMES["annotated"])
+        pipeline = self.create_pipeline()
+        skipped = pipeline.load_checkpoints(pipeline.checkpoint_steps())
+        self.assertEqual(skipped, set(["filtering", "mapping"]))
+
+    def test_stale_checkpoint(self):
+        """
+        Test that a step is not skipped when its output was
+        overwritten after the checkpoint (by a run without --resume)
+        """
+        with open(FILENAMES["annotated"], "w") as filehandler:
+            filehandler.write("overwritten by another run")
+        pipeline = self.create_pipeline()
+        skipped = pipeline.load_checkpoints(pipeline.checkpoint_steps())
+        self.assertEqual(skipped, set(["filtering", "mapping", "demultiplexing"]))
+        self.assertFalse(os.path.isfile(os.path.join(self.tmpdir, "annotation.done")))
+        # A run without --resume removes all the checkpoints
+        pipeline = self.create_pipeline()
+        pipeline.resume = False
+        self.assertEqual(pipeline.load_checkpoints(pipeline.checkpoint_steps()), set())
+        self.assertEqual(self.checkpoints(), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+#! /usr/bin/env python
+"""
+Unit-test the package fastq_utils
+"""
+
+import unittest
+import io
+from stpipeline.common.fastq_utils import quality_trim_index, trim_quality, readfq, FastqWriter
+from stpipeline.common.cfastq_utils import high_content, find_homopolymers
+
+class TestFastqUtils(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        return
+
+    @classmethod
+    def tearDownClass(self):
+        return
+
+    def test_quality_trim_index(self):
+        """
+        Test that the function quality_trim_index finds the correct
+        position to trim low quality 3' ends (BWA approach)
+        """
+        # All bases with good quality (nothing to trim)
+        self.assertEqual(quality_trim_index(b"AAAAAAAAAA", b"IIIIIIIIII", 20, 33), 10)
+        # Last 4 bases are of bad quality
+        self.assertEqual(quality_trim_index(b"AAAAAAAAAA", b"IIIIII####", 20, 33), 6)
+        # G bases at the end are counted as bad quality (NextSeq)
+        self.assertEqual(quality_trim_index(b"AAAAAAGGGG", b"IIIIIIIIII", 20, 33), 6)
+        # Phred 64
+        self.assertEqual(quality_trim_index(b"AAAAAAAAAA", b"hhhhhhBBBB", 20, 64), 6)
+        # Empty read
+        self.assertEqual(quality_trim_index(b"", b"", 20, 33), 0)
+        # Only the bases before the end position
+        self.assertEqual(quality_trim_index(b"AAAAAAAAAA", b"IIII##IIII", 20, 33, 6), 4)
+
+    def test_trim_quality(self):
+        """
+        Test that the function trim_quality trims reads and discards
+        the ones that are too short after the trimming
+        """
+        seq, qual = trim_quality(b"AAAAAAAAAA", b"IIIIII####", 20, 5, 33)
+        self.assertEqual(seq, b"AAAAAA")
+        self.assertEqual(qual, b"IIIIII")
+        seq, qual = trim_quality(b"AAAAAAAAAA", b"II########", 20, 5, 33)
+        self.assertTrue(seq is None and qual is None)
+        seq, qual = trim_quality(b"AAAA", b"IIII", 20, 5, 33)
+        self.assertTrue(seq is None and qual is None)
+        # Reads already trimmed at a given end position
+        seq, qual = trim_quality(b"AAAAAAAAAA", b"IIIIIIII##", 20, 5, 33, 7)
+        self.assertEqual(seq, b"AAAAAAA")
+        self.assertEqual(qual, b"IIIIIII")
+        seq, qual = trim_quality(b"AAAAAAAAAA", b"IIIIIIIIII", 20, 5, 33, 4)
+        self.assertTrue(seq is None and qual is None)
+
+    def test_high_content(self):
+        """
+        Test that the function high_content finds the reads
+        with a high content of the given bases
+        """
+        sequences = [b"AATTAATTAT", b"AATTAATTGC", b"", b"GCGCGCGCGC"]
+        self.assertEqual(list(high_content(sequences, b"AT", 90)), [1, 0, 1, 0])
+        self.assertEqual(list(high_content(sequences, b"AT", 80)), [1, 1, 1, 0])
+        self.assertEqual(list(high_content(sequences, b"GC", 90)), [0, 0, 1, 1])
+        self.assertEqual(list(high_content([], b"AT", 90)), [])
+
+    def test_find_homopolymers(self):
+        """
+        Test that the function find_homopolymers removes the
+        homopolymers in order and stops when the read is too short
+        """
+        sequence = b"CCCCCCCCCCTTTTTGGGGGAAAAACCCCC"
+        self.assertEqual(find_homopolymers(sequence, b"AT", (5, 5), 30), 10)
+        self.assertEqual(find_homopolymers(sequence, b"AT", (5, 5), 30, 20), 20)
+        self.assertEqual(find_homopolymers(sequence, b"AT", (5, 5), 18), 10)
+        self.assertEqual(find_homopolymers(sequence, b"G", (5,), 18), 18)
+        self.assertEqual(find_homopolymers(sequence, b"T", (6,), 30), 30)
+        self.assertEqual(find_homopolymers(sequence, b"C", (5,), 30), 0)
+        self.assertEqual(find_homopolymers(sequence, b"", (), 30), 30)
+
+    def test_readfq(self):
+        """
+        Test that the function readfq parses correctly fastq records
+        even when they are split between blocks
+        """
+        records = [(b"read1 1:N:0:1", b"ACGTN", b"IIII#"),
+                   (b"read2 1:N:0:1", b"GGGGG", b"AAAAA"),
+                   (b"read3 1:N:0:1", b"TTTTTTTT", b"IIIIIIII")]
+        content = b"".join(b"@" + h + b"\n" + s + b"\n+\n" + q + b"\n" for h, s, q in records)
+        for block_size in [3, 7, 1024]:
+            self.assertEqual(list(readfq(io.BytesIO(content), block_size)), records)
+        # Last record without a new line at the end
+        self.assertEqual(list(readfq(io.BytesIO(content[:-1]), 5)), records)
+        # Truncated record
+        with self.assertRaises(ValueError):
+            list(readfq(io.BytesIO(content[:-11]), 5))
+        # Plus lines with the name and qualities of a different length
+        content = b"@read1\nACGT\n+read1\nIIII\n@read2\nACGT\n+\nIIIIII\n@read3\nAC\n+\nII\n"
+        self.assertEqual(list(readfq(io.BytesIO(content))), 
+                         [(b"read1", b"ACGT", b"IIII"), (b"read2", b"ACGT", b"IIIIII"), 
+                          (b"read3", b"AC", b"II")])
+        # Windows new lines
+        content = b"".join(b"@" + h + b"\r\n" + s + b"\r\n+\r\n" + q + b"\r\n" for h, s, q in records)
+        for block_size in [3, 7, 1024]:
+            self.assertEqual(list(readfq(io.BytesIO(content), block_size)), records)
+        self.assertEqual(list(readfq(io.BytesIO(content[:-2]), 5)), records)
+        # Empty lines between the records
+        content = b"".join(b"\n@" + h + b"\n" + s + b"\n+\n" + q + b"\n\n" for h, s, q in records)
+        for block_size in [3, 7, 1024]:
+            self.assertEqual(list(readfq(io.BytesIO(content), block_size)), records)
+
+    def test_fastq_writer(self):
+        """
+        Test that the records written with FastqWriter
+        are parsed back by readfq
+        """
+        records = [(b"read1 1:N:0:1", b"ACGTN", b"IIII#"),
+                   (b"read2 1:N:0:1", b"GGGGG", b"AAAAA")]
+        handler = io.BytesIO()
+        writer = FastqWriter(handler)
+        for record in records:
+            writer.write(record)
+        writer.flush()
+        self.assertEqual(handler.getvalue(), 
+                         b"@read1 1:N:0:1\nACGTN\n+\nIIII#\n@read2 1:N:0:1\nGGGGG\n+\nAAAAA\n")
+        handler.seek(0)
+        self.assertEqual(list(readfq(handler)), records)
+        # Records are only written when the buffer is full
+        handler = io.BytesIO()
+        writer = FastqWriter(handler, 30)
+        writer.write(records[0])
+        self.assertEqual(handler.getvalue(), b"")
+        writer.write(records[1])
+        self.assertEqual(len(handler.getvalue()), 58)
+
+if __name__ == '__main__':
+    unittest.main()